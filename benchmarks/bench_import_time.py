@@ -0,0 +1,80 @@
+"""
+Import-time benchmark for the lightweight mapping module (timestamps.mapping).
+
+Imports the module in fresh interpreters and fails (exit code 1) if the median
+import time exceeds the budget, or if any heavy dependency was imported along
+with it. Run with:
+
+    python benchmarks/bench_import_time.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Repository root, so the package is importable without installing it
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Module whose import time is guarded
+MODULE = 'timestamps.mapping'
+
+# Dependencies that must not be imported by MODULE
+HEAVY_MODULES = ['pandas', 'matplotlib', 'harp', 'open_ephys', 'scipy']
+
+# Maximum median import time of MODULE (s), on top of the import of NumPy
+BUDGET_S = 0.05
+
+# Code run in a fresh interpreter: import NumPy first so that only the cost of
+# MODULE itself is timed, then report the import time and heavy modules loaded
+PROBE = """
+import json, sys, time
+import numpy
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+heavy = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy}))
+print(json.dumps({{'seconds': t1 - t0, 'heavy': heavy}}))
+"""
+
+def measure(module, repeats):
+    """
+    Import a module in `repeats` fresh interpreters.
+
+    Returns:
+    tuple: list of import times (s), and sorted list of heavy modules imported.
+    """
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    times, heavy = [], set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=REPO_ROOT)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        heavy.update(result['heavy'])
+    return times, sorted(heavy)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=10, help='number of fresh interpreters to import in')
+    parser.add_argument('--budget', type=float, default=BUDGET_S, help='maximum median import time (s)')
+    args = parser.parse_args()
+
+    times, heavy = measure(MODULE, args.repeats)
+    median = statistics.median(times)
+    print(f'import {MODULE}: median {median * 1e3:.2f} ms, min {min(times) * 1e3:.2f} ms over {args.repeats} runs')
+
+    failures = []
+    if heavy:
+        failures.append(f'{MODULE} imports heavy dependencies: {", ".join(heavy)}')
+    if median > args.budget:
+        failures.append(f'median import time {median * 1e3:.2f} ms exceeds budget of {args.budget * 1e3:.2f} ms')
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if not failures:
+        print('PASS')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
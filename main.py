@@ -1,69 +1,41 @@
-from timestamps.harp.get_harp_timestamps_df import harp_session
-from timestamps.OpenEphys.open_ephys_utils import openephys_session
+from timestamps.pipeline import session_pipeline
+from timestamps.catalog import session_catalog
 
 animal_ID = 'FNT103'
 session_ID = '2024-08-26T14-37-42'
 
-print(f"Starting analysis of {animal_ID} for session {session_ID}...")
-
-#==============================================================================
-# Read in harp and OpenEphys session data
-#==============================================================================
-
-harp = harp_session(animal_ID, session_ID)
-oe = openephys_session(animal_ID, session_ID)
-
-#==============================================================================
-# Check TTLs
-#==============================================================================
-# NOTE: need to write some automated flag for whether to sync to master clock 
-# or not for a given session
-
-# Check TTls from harp exist and look as expected
-harp.read_ttl()
-harp.plot_ttl(100)
-
-# Check TTls from OpenEphys exist and look as expected
-oe.read_TTLs()
-oe.plot_TTLs(100)
-
-#==============================================================================
-# Sync to master clock
-#==============================================================================
-# NOTE: need to add an if statement to check that TTLs exist in both harp and
-# OpenEphys, and look as expected before syncing
-
-oe.sync_harp_ttls()
-
-# Sync harp data streams to ephys master clock
-harp.sound_events['ephys_timestamp'] = oe.tm.get_pxie_timestamp(harp.sound_events['Time'])
-harp.poke_events['ephys_timestamp'] = oe.tm.get_pxie_timestamp(harp.poke_events.index)
-harp.photodiode_data['ephys_timestamp'] = oe.tm.get_pxie_timestamp(harp.photodiode_data.index)
-
-# Construct a new data frame the same as trials_df but with harp clock 
-# timestamps replaced with ephys clock timestamps
-trials_df = harp.trials_df
-timestamped_variables = [
-    'TrialStart', 
-    'TrialEnd', 
-    'DotOnsetTime', 
-    'DotOffsetTime', 
-    'AudioCueStart', 
-    'AudioCueEnd', 
-    'NosepokeInTime'
-]
-for var in timestamped_variables:
-    trials_df[var] = oe.tm.get_pxie_timestamp(trials_df[var])
-harp.trials_df_ephys = trials_df
-
-#==============================================================================
-# Save intermediate aligned to ephys master clock 
-#==============================================================================
-
-# Save harp data and experimental-data .csv in ephys time
-harp.save_harp_data_streams()
-
-# Save trials_df with ephys timestamps
-harp.save_experiment_csv()
-
-print(f"Finished analysis of {animal_ID} for session {session_ID}.")
\ No newline at end of file
+# Process every new or changed session in the session catalog instead of the
+# single session above
+PROCESS_CATALOG = False
+
+# Also retry catalog sessions whose last run failed, even if unchanged
+RETRY_FAILED = False
+
+# Save diagnostic plots of TTLs and of the harp-ephys mapping. Set to False
+# for batch runs, which then never import matplotlib.
+PLOT_TTLS = False
+
+def process_session(animal_ID, session_ID):
+
+    # Run (or resume) the pipeline stages of the session: decode, TTL
+    # extraction, matching, fit, stream mapping and export. Stages whose
+    # inputs are unchanged since their last run are skipped.
+    pipeline = session_pipeline(animal_ID, session_ID, plot = PLOT_TTLS)
+    return pipeline.run()
+
+if __name__ == '__main__':
+
+    if PROCESS_CATALOG:
+        with session_catalog() as catalog:
+            catalog.update()
+            for animal_ID, session_ID in catalog.get_sessions_to_process(retry_failed = RETRY_FAILED):
+                try:
+                    synced = process_session(animal_ID, session_ID)
+                except Exception as error:
+                    print(f"Analysis of {animal_ID} for session {session_ID} failed: {error}")
+                    catalog.mark_failed(animal_ID, session_ID, repr(error))
+                else:
+                    catalog.mark_done(animal_ID, session_ID, synced)
+            print(catalog.get_status_counts())
+    else:
+        process_session(animal_ID, session_ID)
@@ -1,8 +1,6 @@
 from os.path import join
 import os
 from pathlib import Path
-from open_ephys.analysis import Session
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import pickle
@@ -10,12 +8,31 @@ import pickle
 # Import custom functions
 import timestamps.utils.plot_utils as pu
 
+# Mappings between clocks live in a lightweight module, re-exported here
+from timestamps.mapping import pair_timestamps, robust_linear_fit, timestamp_mapping, sample_index_mapping
+
 # path raw data on Ceph repo
 RAW_DATA_ROOT_DIR = "W:\\projects\\FlexiVexi\\raw_data"
 
 # Path to save intermediate variables on Ceph repo
 OUTPUT_ROOT_DIR = "W:\\projects\\FlexiVexi\\data_analysis\\intermediate_variables"
 
+# Sync line of each stream to synchronise. The main stream is used as the master
+# clock, and all other streams are synchronised to it. Add one entry per probe or
+# acquisition board.
+SYNC_LINES = [
+    # 'Heartbeat' signal of ephys clock (1 pulse per second of duration 0.5 seconds)
+    {'stream_name': 'ProbeA', 'line': 1, 'main': True},
+    # 'Heartbeat' signal recorded by the PXIe board (line 4 carries the harp TTL pulses)
+    {'stream_name': 'PXIe-6341', 'line': 1, 'main': False},
+]
+
+# Maximum residual (s) of the linear mapping of a stream to the master clock
+SYNC_MAX_RESIDUAL = 1e-3
+
+# Line on which the TTL pulses shared with harp are recorded
+TTL_LINE = {'stream_name': 'PXIe-6341', 'line': 4}
+
 # Get path to Open-Ephys recording
 def get_record_node_path(root_folder):
     """
@@ -88,9 +105,192 @@ def get_session_path(root_folder):
         if folder_one_level_up is None:
             print('No recording found')
 
+# Get continuous data stream of a recording by stream name
+def get_continuous_stream(recording, stream_name):
+    """
+    Find the continuous data stream with a given name in an Open-Ephys recording.
+
+    Parameters:
+    recording: Open-Ephys recording (from open_ephys.analysis).
+    stream_name (str): Name of the stream, e.g. 'ProbeA'.
+
+    Returns:
+    The continuous data object of the stream.
+
+    Raises:
+    ValueError: If no continuous stream with that name exists.
+    """
+    for continuous in recording.continuous:
+        metadata = continuous.metadata
+        name = metadata['stream_name'] if isinstance(metadata, dict) else metadata.stream_name
+        if name == stream_name:
+            return continuous
+    raise ValueError(f"No continuous stream named '{stream_name}' in recording.")
+
+# -----------------------------------------------------------------------------
+# Sync utils
+# -----------------------------------------------------------------------------
+
+# Get rising edges of the sync line of every stream
+def get_sync_edges(event_df, sync_lines):
+    """
+    Extract the timestamps of the rising edges on the sync line of every stream
+    in a single pass over the events of a recording.
+
+    Parameters:
+    event_df (pd.DataFrame): Events of an Open-Ephys recording, with columns 'stream_name', 'line', 'state' and 'timestamp'.
+    sync_lines (list of dict): Sync specification, with keys 'stream_name' and 'line' for each stream.
+
+    Returns:
+    dict: Maps each stream name to a sorted array of rising edge timestamps (in the stream's local clock).
+    """
+    # Label each event with the index of its sync line in the specification (-1 if none)
+    spec = pd.MultiIndex.from_tuples([(s['stream_name'], s['line']) for s in sync_lines])
+    label = spec.get_indexer(pd.MultiIndex.from_arrays([event_df['stream_name'], event_df['line']]))
+    rising = (label >= 0) & (event_df['state'].to_numpy() == 1)
+
+    # Group rising edges by sync line with a single stable sort
+    label = label[rising]
+    timestamp = event_df['timestamp'].to_numpy(dtype=float)[rising]
+    order = np.lexsort((timestamp, label))
+    bounds = np.searchsorted(label[order], np.arange(len(sync_lines) + 1))
+
+    return {
+        s['stream_name']: timestamp[order[bounds[i]:bounds[i + 1]]]
+        for i, s in enumerate(sync_lines)
+    }
+
+# Match the sync edges of a stream to the sync edges of the main stream
+def match_sync_edges(main_edges, edges):
+    """
+    Pair the sync edges of a stream with the sync edges of the main stream,
+    with the same pairing as harp and ephys TTL pulses (see
+    timestamps.mapping.pair_timestamps): each edge is paired with its mutual
+    nearest main edge under an initial estimate of the mapping between the
+    clocks, corrected for offset and drift. Missing or extra edges in either
+    stream are left unpaired instead of shifting the pairing of all other
+    edges.
+
+    Parameters:
+    main_edges (np.ndarray): Sorted edge timestamps of the main stream.
+    edges (np.ndarray): Sorted edge timestamps of the stream to synchronise.
+
+    Returns:
+    tuple of np.ndarray: Indices into main_edges and edges of the matched pairs.
+    """
+    if len(main_edges) < 2 or len(edges) < 2:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    idx, main_idx = pair_timestamps(edges, main_edges)
+    return main_idx, idx
+
+# Fit the mapping of every stream to the master clock
+def fit_sync_lines(sync_edges, sync_lines, max_residual = SYNC_MAX_RESIDUAL):
+    """
+    Fit a linear mapping (global = scaling * local + offset) from the local
+    clock of every stream to the clock of the main stream. All streams are
+    solved together as a single batched least squares problem.
+
+    Parameters:
+    sync_edges (dict): Maps stream names to rising edge timestamps (see get_sync_edges).
+    sync_lines (list of dict): Sync specification, with exactly one stream with 'main' set to True.
+    max_residual (float): Maximum residual (s) of the matched edges of any stream.
+
+    Returns:
+    dict: Maps each stream name to a dictionary with keys 'line', 'main', 'scaling', 'offset', and the QC of
+    the mapping: 'n_pulses' (matched edges), 'n_unmatched' (edges not matched to the main stream) and
+    'max_residual_ms' and 'rms_residual_ms' (of the matched edges).
+
+    Raises:
+    ValueError: If there is not exactly one main stream, or a stream has fewer than two edges matched to the main
+    stream, or a residual is larger than max_residual.
+    """
+    main_lines = [s for s in sync_lines if s.get('main', False)]
+    if len(main_lines) != 1:
+        raise ValueError("The sync specification must have exactly one main stream.")
+    main_edges = sync_edges[main_lines[0]['stream_name']]
+
+    # Stack matched pairs of all streams, labelled by stream
+    x, y, label = [], [], []
+    for i, sync_line in enumerate(sync_lines):
+        main_idx, idx = match_sync_edges(main_edges, sync_edges[sync_line['stream_name']])
+        if len(idx) < 2:
+            raise ValueError(f"Fewer than two sync pulses of '{sync_line['stream_name']}' match the main stream.")
+        x.append(sync_edges[sync_line['stream_name']][idx])
+        y.append(main_edges[main_idx])
+        label.append(np.full(len(idx), i))
+    x, y, label = np.concatenate(x), np.concatenate(y), np.concatenate(label)
+
+    # Closed-form least squares for every stream at once, centred for numerical stability
+    n = np.bincount(label, minlength=len(sync_lines))
+    x_mean = np.bincount(label, x, len(sync_lines)) / n
+    y_mean = np.bincount(label, y, len(sync_lines)) / n
+    dx, dy = x - x_mean[label], y - y_mean[label]
+    scaling = np.bincount(label, dx * dy, len(sync_lines)) / np.bincount(label, dx * dx, len(sync_lines))
+    offset = y_mean - scaling * x_mean
+
+    # Residuals of the matched edges of every stream
+    residuals = y - (scaling[label] * x + offset[label])
+    max_residuals = np.zeros(len(sync_lines))
+    np.maximum.at(max_residuals, label, np.abs(residuals))
+    rms_residuals = np.sqrt(np.bincount(label, residuals ** 2, len(sync_lines)) / n)
+
+    sync_mappings = {}
+    for i, sync_line in enumerate(sync_lines):
+        if max_residuals[i] > max_residual:
+            raise ValueError(
+                f"Sync pulses of '{sync_line['stream_name']}' do not map linearly to the main stream "
+                f"(max residual {max_residuals[i] * 1e3:.3f} ms)."
+            )
+        main = sync_line.get('main', False)
+        sync_mappings[sync_line['stream_name']] = {
+            'line': sync_line['line'],
+            'main': main,
+            # The main stream is the master clock
+            'scaling': 1.0 if main else float(scaling[i]),
+            'offset': 0.0 if main else float(offset[i]),
+            'n_pulses': int(n[i]),
+            'n_unmatched': int(len(sync_edges[sync_line['stream_name']]) - n[i]),
+            'max_residual_ms': float(max_residuals[i] * 1e3),
+            'rms_residual_ms': float(rms_residuals[i] * 1e3),
+        }
+
+    return sync_mappings
+
+# Get onsets of the TTL pulses recorded by harp and the PXIe board
+def get_ttl_onsets(harp_ttl, TTL_pulses):
+    """
+    Find the onsets (rises) of the TTL pulses recorded by harp and by the PXIe board.
+
+    Parameters:
+    harp_ttl (pd.DataFrame): Harp TTL events, with columns 'timestamp' and 'state' (harp_session.ttl_state_df).
+    TTL_pulses (pd.DataFrame): PXIe TTL events, with columns 'global_timestamp' and 'state' (openephys_session.TTL_pulses).
+
+    Returns:
+    tuple of pd.DataFrame: Rows of harp_ttl and TTL_pulses that are onsets, with an added 'diff' column.
+    """
+    #Make  ttl diff to find  onset moments
+    ttl_diff = np.zeros_like(TTL_pulses['state'])
+    if len(ttl_diff):
+        ttl_diff[0] = 1 #The first event will always be a rise with  the first pulse
+        ttl_diff[1:] = np.diff(TTL_pulses['state'])
+    TTL_pulses = TTL_pulses.assign(diff = ttl_diff)
+
+    #Make harp diff
+    harp_diff = np.zeros_like(harp_ttl['state'])
+    if len(harp_diff):
+        harp_diff[0] = 0
+        harp_diff[1:] = np.diff(harp_ttl['state'])
+    harp_ttl = harp_ttl.assign(diff = harp_diff)
+
+    harp_onset =  harp_ttl[harp_ttl['diff']==1]
+    pxie_onset = TTL_pulses[TTL_pulses['diff']==1]
+
+    return harp_onset, pxie_onset
+
 class openephys_session():
 
-    def __init__(self, animal_ID, session_ID, raw_data_dir = RAW_DATA_ROOT_DIR, output_dir = OUTPUT_ROOT_DIR):
+    def __init__(self, animal_ID, session_ID, raw_data_dir = RAW_DATA_ROOT_DIR, output_dir = OUTPUT_ROOT_DIR, sync_lines = SYNC_LINES, ttl_line = TTL_LINE):
 
         raw_data_session_dir = os.path.join(raw_data_dir, animal_ID, session_ID)
         output_session_dir = os.path.join(output_dir, animal_ID, session_ID)
@@ -103,12 +303,19 @@ class openephys_session():
         self.session_ID = session_ID
         self.raw_data_session_dir = raw_data_session_dir
         self.output_session_dir = output_session_dir
+        self.sync_lines = sync_lines
+        self.ttl_line = ttl_line
 
         # Q: WHY IS THIS NEEDED?
         self.raw_data_root_dir = RAW_DATA_ROOT_DIR
         self.output_root_dir = OUTPUT_ROOT_DIR
 
+        # Import open_ephys only when a session is loaded
+        from open_ephys.analysis import Session
+
         ephys_session_path = get_session_path(raw_data_session_dir)
+        if ephys_session_path is None:
+            raise ValueError(f"No Open-Ephys recording found in {raw_data_session_dir}.")
         self.session = Session(ephys_session_path)
         print(self.session)
 
@@ -117,42 +324,53 @@ class openephys_session():
         # Create output directory for session
         os.makedirs(output_session_dir, exist_ok = True)
     
-    def get_PXI_processor_ID(self):
-        idx = self.recording.events['stream_name'] == 'PXIe-6341'
-        processor_IDs = self.recording.events['processor_id'][idx]
-        PXI_processor_ID = int(processor_IDs.unique()[0])        
-        return PXI_processor_ID
-    
+    def get_processor_IDs(self):
+        '''
+        Returns a dictionary mapping the name of each event stream to its processor ID
+        '''
+        streams = self.recording.events[['stream_name', 'processor_id']].drop_duplicates('stream_name')
+        return {name: int(ID) for name, ID in zip(streams['stream_name'], streams['processor_id'])}
+
     def read_TTLs(self):
 
         self.sync_data()
 
-        self.recording.compute_global_timestamps(overwrite=False)
-        event_df = self.recording.events
-        TTL_pulses = event_df[(event_df['stream_name'] == 'PXIe-6341') & (event_df['line'] == 4)]
+        event_df = self.events
+        TTL_pulses = event_df[(event_df['stream_name'] == self.ttl_line['stream_name']) & (event_df['line'] == self.ttl_line['line'])]
         TTL_pulses = TTL_pulses.reset_index(drop=True)
         self.TTL_pulses = TTL_pulses
 
     def sync_data(self):
+        '''
+        Synchronises all streams in self.sync_lines to the main stream (master
+        clock). Sync edges of all streams are extracted in a single pass over
+        the recording events and all mappings are fitted together, then saved
+        in sync_mappings.pkl. Adds a 'global_timestamp' column to the events
+        of all synchronised streams (self.events).
+        '''
+        event_df = self.recording.events
 
-        # Get processor ID of PXIe-6341 stream
-        PXI_processor_ID = self.get_PXI_processor_ID()
+        # Check that all streams in the sync specification were recorded
+        processor_IDs = self.get_processor_IDs()
+        for sync_line in self.sync_lines:
+            if sync_line['stream_name'] not in processor_IDs:
+                raise ValueError(f"No events recorded in stream '{sync_line['stream_name']}'.")
 
-        # Sync line corresponding to heartbeat signal of ephys clock (1 pulse per second of duration 0.5 seconds). 
-        # Use this as the master clock (set main = True).
-        self.recording.add_sync_line(1,                     # 'Heartbeat' signal line number
-                                100,                        # processor ID
-                                'ProbeA',                   # stream name
-                                main=True)                  # use as the main stream
+        sync_edges = get_sync_edges(event_df, self.sync_lines)
+        self.sync_mappings = fit_sync_lines(sync_edges, self.sync_lines)
+        for stream_name, mapping in self.sync_mappings.items():
+            mapping['processor_id'] = processor_IDs[stream_name]
 
+        # Transform event timestamps of all synchronised streams to the master clock
+        scaling = event_df['stream_name'].map({k: v['scaling'] for k, v in self.sync_mappings.items()})
+        offset = event_df['stream_name'].map({k: v['offset'] for k, v in self.sync_mappings.items()})
+        self.events = event_df.assign(global_timestamp = scaling * event_df['timestamp'] + offset)
 
-        # Sync line corresponding to TTL pulses
-        self.recording.add_sync_line(4,              # TTL line number
-                                PXI_processor_ID,           # processor ID
-                                'PXIe-6341',                # stream name
-                                main=False)                 # synchronize to main stream
+        with open(join(self.output_session_dir, 'sync_mappings.pkl'), 'wb') as file:
+            pickle.dump(self.sync_mappings, file)
 
     def plot_TTLs(self, seconds = 20):
+        import matplotlib.pyplot as plt
         plt.figure(figsize=(12, 6))  # Set the figure size (width, height) in inches
         ttl_pulse = pu.get_square_wave(self.TTL_pulses)
         ttl_pulse.plot(x='timestamp', y='state', linewidth=0.5)
@@ -164,79 +382,55 @@ class openephys_session():
         plt.xlim(t0+50, t0+50+seconds)
         plt.savefig(join(self.output_session_dir, 'TTLs_PXIe_board.png'))
     
-    def sync_harp_ttls(self):
-
-        #Make  ttl diff to find  onset moments
-        ttl_diff = np.zeros_like(self.TTL_pulses['state'])
-        ttl_diff[0] = 1 #The first event will always be a rise with  the first pulse
-        ttl_diff[1:] = np.diff(self.TTL_pulses['state'])
-        self.TTL_pulses['diff'] =  ttl_diff
-
+    def sync_harp_ttls(self, fit_method = 'robust', plot = True, harp_ttl = None):
+        '''
+        Fits the mapping from harp to pxie timestamps (self.tm) from the onsets
+        of the TTL pulses recorded by both, and saves it. harp_ttl is the harp
+        TTL state data frame (harp_session.ttl_state_df); if None, it is read
+        from TTLs_harp.csv (saved by harp_session.read_ttl).
+        '''
         #Read harp timestamps
-        harp_path = join(self.output_session_dir,  'TTLs_harp.csv')
-        self.harp_ttl = pd.read_csv(harp_path)
+        if harp_ttl is None:
+            harp_path = join(self.output_session_dir,  'TTLs_harp.csv')
+            harp_ttl = pd.read_csv(harp_path)
+        self.harp_ttl = harp_ttl
 
-        #Make harp diff
-        harp_diff = np.zeros_like(self.harp_ttl['state'])
-        harp_diff[0] = 0
-        harp_diff[1:] = np.diff(self.harp_ttl['state'])
-        self.harp_ttl['diff'] = harp_diff
-
-        harp_onset =  self.harp_ttl[self.harp_ttl['diff']==1]
-        pxie_onset = self.TTL_pulses[self.TTL_pulses['diff']==1]
+        harp_onset, pxie_onset = get_ttl_onsets(self.harp_ttl, self.TTL_pulses)
 
-        self.tm = timestamp_mapping(harp_onset, pxie_onset,  self.output_session_dir)
-        self.tm.plot_residuals()
+        self.tm = timestamp_mapping(harp_onset, pxie_onset,  self.output_session_dir, fit_method)
+        if plot:
+            self.tm.plot_residuals()
 
-        with open(join(self.output_session_dir, 'timestamp_mapping.pkl'), 'wb') as file:
-            pickle.dump(self.tm, file)
+        self.tm.save()
 
-class timestamp_mapping():
-    '''
-    Calculates a mapping between harp and pxie timestamps. Will print
-    some diagnostic plots and be unpickled  if neccessary to map arbitrary
-    harp timestamps.  
-    '''
-    def __init__(self, harp_onset, pxie_onset, output_session_dir):
-        self.output_session_dir = output_session_dir
-        self.harp_onset = harp_onset
-        self.pxie_onset = pxie_onset
-
-        print(f'There are {len(self.harp_onset)} harp rises and {len(self.pxie_onset)} pxie rises')
-        if len(self.harp_onset) != len(self.pxie_onset):
-            print('CAREFUL! There does not seem to be an equal number of rise events.')
-            
-        #Fit the polynomial
-        self.fit = np.polynomial.polynomial.Polynomial.fit(harp_onset['timestamp'], pxie_onset['global_timestamp'], 1)
-        #Extract intercept and slope
-        self.intercept = self.fit.convert().coef[0]
-        self.slope = self.fit.convert().coef[1]
-    
-    def get_pxie_timestamp(self, new_data):
+    def map_probe_samples(self, stream_name = 'ProbeA'):
         '''
-        Uses the linear fit to return pxie timestamps when given harp timestamps
+        Builds a mapping between ephys global timestamps and sample indices of
+        the continuous data of a probe stream. The stream must be in the sync
+        specification, and synchronised first (i.e. run read_TTLs first).
         '''
-        pxie_timestamp = self.fit(new_data)
-        return pxie_timestamp
-    
-    def plot_residuals(self):
+        continuous = get_continuous_stream(self.recording, stream_name)
+        sync_mapping = self.sync_mappings[stream_name]
+        self.sm = sample_index_mapping.from_continuous(
+            continuous,
+            self.output_session_dir,
+            stream_name,
+            scaling = sync_mapping['scaling'],
+            offset = sync_mapping['offset']
+        )
+
+        with open(join(self.output_session_dir, f'{stream_name}_sample_mapping.pkl'), 'wb') as file:
+            pickle.dump(self.sm, file)
+
+    def get_probe_sample_index(self, harp_timestamps):
         '''
-        Calculates and plots the residuals of the  conversion. USeful to check 
-        if  there  are any outliers. 
+        Maps harp timestamps to sample indices of the probe continuous data,
+        via the harp-pxie timestamp mapping.
         '''
-        self.predicted = self.get_pxie_timestamp(self.harp_onset['timestamp'])
-        self.residuals = np.array(self.pxie_onset['global_timestamp']) -  np.array(self.predicted)
-
-        #and plot the stuff
-        fig, ax =  plt.subplots()
-        ax.hist(self.residuals)
-        ax.set_xlabel('Actual-predicted pxie timestamp (s)')
-        ax.set_ylabel('Count')
-        fig.suptitle('Residuals from harp-pxie timestamp mapping')
-        fig.savefig(join(self.output_session_dir, 'harp_residuals.png'))
-        
-
-
-
-
+        return self.sm.get_sample_index(self.tm.get_pxie_timestamp(harp_timestamps))
 
+    def get_harp_timestamp_from_sample(self, sample_index):
+        '''
+        Maps sample indices of the probe continuous data back to harp time.
+        '''
+        return self.tm.get_harp_timestamp(self.sm.get_global_timestamp(sample_index))
@@ -0,0 +1,193 @@
+from os.path import join
+import json
+import os
+
+import numpy as np
+
+# -----------------------------------------------------------------------------
+# Binary, memory-mappable copies of the aligned outputs of a session. Each
+# stream is saved as a folder of .npy files (one per column) under
+# {output session dir}/streams/{stream name}, with a sparse index of every
+# sorted time column, so that time ranges can be read without loading whole
+# files. Like timestamps.mapping, this module only imports NumPy.
+# -----------------------------------------------------------------------------
+
+# Folder, under the output session directory, in which streams are saved
+STREAMS_DIRNAME = 'streams'
+
+# Time column of each clock
+TIME_COLUMNS = {
+    'harp': 'harp_timestamp',
+    'ephys': 'ephys_timestamp',
+}
+
+# Number of rows between entries of the sparse time index
+INDEX_STEP = 64
+
+# Maximum number of queries searched at once (bounds the memory of a search)
+QUERY_CHUNK = 16384
+
+def save_stream(output_session_dir, stream_name, columns, categories = None, index_step = INDEX_STEP):
+    """
+    Save a data stream as one .npy file per column, with a sparse index of
+    every time column that is sorted. Files of a previous save of the stream
+    that this save does not write (e.g. ephys time columns of a session no
+    longer synced) are deleted.
+
+    Parameters:
+    output_session_dir (str): Output directory of the session.
+    stream_name (str): Name of the stream, e.g. 'poke_events'.
+    columns (dict): Maps column names to 1D arrays of equal length. Must include 'harp_timestamp'.
+    categories (dict): Maps names of categorical columns (saved as integer codes) to their categories.
+    index_step (int): Number of rows between entries of the sparse time index.
+
+    Returns:
+    list of str: Paths of the files written.
+    """
+    stream_dir = join(output_session_dir, STREAMS_DIRNAME, stream_name)
+    os.makedirs(stream_dir, exist_ok = True)
+
+    n_rows = len(columns[TIME_COLUMNS['harp']])
+    indexed = []
+    paths = [join(stream_dir, 'meta.json')]
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if len(values) != n_rows:
+            raise ValueError(f"Column '{name}' of stream '{stream_name}' has {len(values)} rows, expected {n_rows}.")
+        paths.append(join(stream_dir, f'{name}.npy'))
+        np.save(paths[-1], values)
+
+        # Index time columns that can be searched (e.g. not ephys time of unsynced sessions)
+        if name in TIME_COLUMNS.values() and n_rows > 0 and not np.isnan(values).any() and np.all(values[1:] >= values[:-1]):
+            paths.append(join(stream_dir, f'{name}_index.npy'))
+            np.save(paths[-1], values[::index_step])
+            indexed.append(name)
+
+    with open(join(stream_dir, 'meta.json'), 'w') as file:
+        json.dump({
+            'n_rows': n_rows,
+            'columns': list(columns),
+            'indexed_columns': indexed,
+            'index_step': index_step,
+            'categories': categories or {},
+        }, file, indent=4)
+
+    for filename in os.listdir(stream_dir):
+        if join(stream_dir, filename) not in paths:
+            os.remove(join(stream_dir, filename))
+
+    return paths
+
+class aligned_stream():
+    '''
+    A saved data stream, with columns memory-mapped on first access.
+    '''
+    def __init__(self, stream_dir):
+        self.stream_dir = stream_dir
+        with open(join(stream_dir, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        self.n_rows = meta['n_rows']
+        self.columns = meta['columns']
+        self.indexed_columns = meta['indexed_columns']
+        self.index_step = meta['index_step']
+        self.categories = meta['categories']
+        self._columns = {}
+        self._indices = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            if column not in self.columns:
+                raise KeyError(f"No column '{column}' in stream {self.stream_dir}.")
+            self._columns[column] = np.load(join(self.stream_dir, f'{column}.npy'), mmap_mode='r')
+        return self._columns[column]
+
+    def get_index(self, column):
+        # Sparse index of a time column (every index_step-th value), loaded in memory
+        if column not in self.indexed_columns:
+            raise ValueError(f"Column '{column}' of stream {self.stream_dir} is not indexed (not a sorted time column).")
+        if column not in self._indices:
+            self._indices[column] = np.load(join(self.stream_dir, f'{column}_index.npy'))
+        return self._indices[column]
+
+    def searchsorted(self, column, values, side = 'left'):
+        '''
+        Equivalent to np.searchsorted(self[column], values, side), but only
+        reads one block of index_step rows of the column per query: the sparse
+        index gives the block, and the position within the block is counted.
+        '''
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        data, index, step = self[column], self.get_index(column), self.index_step
+        positions = np.empty(len(values), dtype=np.int64)
+
+        for start in range(0, len(values), QUERY_CHUNK):
+            chunk = values[start:start + QUERY_CHUNK]
+            # Rows before the block are all below the value (above, for side='right')
+            block = np.maximum(np.searchsorted(index, chunk, side) - 1, 0) * step
+            rows = block[:, None] + np.arange(step)
+            valid = rows < self.n_rows
+            block_values = data[np.minimum(rows, self.n_rows - 1)]
+            below = block_values < chunk[:, None] if side == 'left' else block_values <= chunk[:, None]
+            positions[start:start + QUERY_CHUNK] = block + (below & valid).sum(axis=1)
+
+        return positions
+
+class aligned_session_reader():
+    '''
+    Reads time ranges of the saved aligned outputs of a session (see
+    save_stream) without loading whole files. Streams are opened lazily and
+    their columns memory-mapped, and time ranges are found with the sparse
+    time index of each stream. Times are in harp or ephys time (clock).
+    '''
+    def __init__(self, output_session_dir):
+        self.output_session_dir = output_session_dir
+        self.streams_dir = join(output_session_dir, STREAMS_DIRNAME)
+        self.stream_names = sorted(os.listdir(self.streams_dir)) if os.path.isdir(self.streams_dir) else []
+        self._streams = {}
+
+    def get_stream(self, stream_name):
+        if stream_name not in self._streams:
+            if stream_name not in self.stream_names:
+                raise KeyError(f"No stream '{stream_name}' in {self.streams_dir}.")
+            self._streams[stream_name] = aligned_stream(join(self.streams_dir, stream_name))
+        return self._streams[stream_name]
+
+    def get_bounds(self, stream_name, t_starts, t_ends, clock = 'ephys'):
+        '''
+        Returns the row bounds (start, end) of the windows t_start <= time <
+        t_end, as arrays, for any number of windows.
+        '''
+        stream = self.get_stream(stream_name)
+        time_column = TIME_COLUMNS[clock]
+        return stream.searchsorted(time_column, t_starts), stream.searchsorted(time_column, t_ends)
+
+    def get_range(self, stream_name, t_start, t_end, clock = 'ephys', columns = None):
+        '''
+        Returns a dictionary of the columns (all by default) of a stream in the
+        time range t_start <= time < t_end. Values are read-only views of the
+        memory-mapped files.
+        '''
+        stream = self.get_stream(stream_name)
+        starts, ends = self.get_bounds(stream_name, t_start, t_end, clock)
+        return {column: stream[column][starts[0]:ends[0]] for column in (columns or stream.columns)}
+
+    def get_ranges(self, stream_name, t_starts, t_ends, clock = 'ephys', columns = None):
+        '''
+        Batched version of get_range for many windows. Returns a dictionary of
+        the columns (all by default) of all rows in any window, concatenated in
+        window order, with an extra 'window' column giving the index of the
+        window of each row (rows in overlapping windows are repeated).
+        '''
+        stream = self.get_stream(stream_name)
+        starts, ends = self.get_bounds(stream_name, t_starts, t_ends, clock)
+        counts = np.maximum(ends - starts, 0)
+
+        # Row of each output element: starts of each window plus offsets within it
+        window = np.repeat(np.arange(len(counts)), counts)
+        rows = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        output = {column: np.asarray(stream[column][rows]) for column in (columns or stream.columns)}
+        output['window'] = window
+        return output
@@ -0,0 +1,191 @@
+from os.path import join
+from datetime import datetime
+import hashlib
+import os
+import sqlite3
+
+# Index the same directories the pipeline processes
+from timestamps.harp.get_harp_timestamps_df import RAW_DATA_ROOT_DIR, OUTPUT_ROOT_DIR
+
+# Name of the catalog database, saved under the output root directory
+CATALOG_FILENAME = 'session_catalog.sqlite'
+
+# -----------------------------------------------------------------------------
+# Session discovery
+# -----------------------------------------------------------------------------
+
+def find_sessions(raw_data_dir):
+    """
+    List all sessions under the raw data directory, which has the file
+    structure {Raw Data Directory} / {Animal ID} / {Session ID}.
+
+    Parameters:
+    raw_data_dir (str): Raw data root directory.
+
+    Returns:
+    list of tuple: (animal_ID, session_ID) of every session folder, sorted.
+    """
+    sessions = []
+    for animal in os.scandir(raw_data_dir):
+        if not animal.is_dir():
+            continue
+        for session in os.scandir(animal.path):
+            if session.is_dir():
+                sessions.append((animal.name, session.name))
+    return sorted(sessions)
+
+def get_session_fingerprint(raw_data_session_dir):
+    """
+    Fingerprint the source files of a session from their relative paths, sizes
+    and modification times. Files are not read, so this is fast even for large
+    ephys recordings, and any added, removed or rewritten file changes it.
+
+    Parameters:
+    raw_data_session_dir (str): Raw data directory of the session.
+
+    Returns:
+    str: Hex digest of the fingerprint.
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(raw_data_session_dir):
+        for filename in filenames:
+            path = join(dirpath, filename)
+            stat = os.stat(path)
+            entries.append(f'{os.path.relpath(path, raw_data_session_dir)}|{stat.st_size}|{stat.st_mtime_ns}')
+
+    digest = hashlib.sha1()
+    for entry in sorted(entries):
+        digest.update(entry.encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+# -----------------------------------------------------------------------------
+# Session catalog
+# -----------------------------------------------------------------------------
+
+class session_catalog():
+    '''
+    Persistent catalog (SQLite, under the output root directory) of all
+    sessions under the raw data directory, with the fingerprint of their
+    source files, and the pipeline version, fingerprint and status of their
+    last run. Used to only (re)process sessions that are new, have changed
+    or were processed by another pipeline version (and, on request, sessions
+    whose last run failed). The pipeline version includes a hash of the
+    pipeline code (see pipeline.get_pipeline_version), so any code change
+    marks all sessions for reprocessing.
+
+    Statuses:
+    - 'new': never processed.
+    - 'done': processed and synced to the ephys master clock.
+    - 'done_harp_time': processed, but TTL QC failed so outputs are in harp time only.
+    - 'failed': the last run raised an error (see the message column).
+    '''
+    def __init__(self, raw_data_dir = RAW_DATA_ROOT_DIR, output_dir = OUTPUT_ROOT_DIR, pipeline_version = None):
+
+        self.raw_data_root_dir = raw_data_dir
+        self.output_root_dir = output_dir
+        if pipeline_version is None:
+            # Imported here, as the pipeline imports this module
+            from timestamps.pipeline import get_pipeline_version
+            pipeline_version = get_pipeline_version()
+        self.pipeline_version = pipeline_version
+
+        os.makedirs(output_dir, exist_ok = True)
+        self.db_path = join(output_dir, CATALOG_FILENAME)
+        self.connection = sqlite3.connect(self.db_path)
+
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    animal_ID TEXT NOT NULL,
+                    session_ID TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'new',
+                    processed_fingerprint TEXT,
+                    pipeline_version TEXT,
+                    message TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (animal_ID, session_ID)
+                )
+            ''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS sessions_status ON sessions (status)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self):
+        '''
+        Index all sessions under the raw data directory, and refresh the
+        fingerprint of their source files. Status of previous runs is kept.
+        Returns the number of sessions indexed.
+        '''
+        rows = [
+            (animal_ID, session_ID, get_session_fingerprint(join(self.raw_data_root_dir, animal_ID, session_ID)))
+            for animal_ID, session_ID in find_sessions(self.raw_data_root_dir)
+        ]
+        with self.connection:
+            self.connection.executemany('''
+                INSERT INTO sessions (animal_ID, session_ID, fingerprint) VALUES (?, ?, ?)
+                ON CONFLICT (animal_ID, session_ID) DO UPDATE SET fingerprint = excluded.fingerprint
+            ''', rows)
+        return len(rows)
+
+    def get_sessions_to_process(self, retry_failed = False):
+        '''
+        Returns (animal_ID, session_ID) of all sessions that are new, have
+        changed since they were processed, or were processed by another
+        pipeline version. Sessions whose last run failed are only retried if
+        they have changed (or the pipeline version has), unless retry_failed
+        is True.
+        '''
+        return self.connection.execute('''
+            SELECT animal_ID, session_ID FROM sessions
+            WHERE status = 'new'
+                OR processed_fingerprint IS NOT fingerprint
+                OR pipeline_version IS NOT ?
+                OR (? AND status = 'failed')
+            ORDER BY animal_ID, session_ID
+        ''', (self.pipeline_version, retry_failed)).fetchall()
+
+    def _set_status(self, animal_ID, session_ID, status, message = None):
+        with self.connection:
+            self.connection.execute('''
+                UPDATE sessions
+                SET status = ?, processed_fingerprint = fingerprint, pipeline_version = ?, message = ?, updated_at = ?
+                WHERE animal_ID = ? AND session_ID = ?
+            ''', (status, self.pipeline_version, message, datetime.now().isoformat(timespec='seconds'), animal_ID, session_ID))
+
+    def mark_done(self, animal_ID, session_ID, synced = True):
+        '''
+        Record a successful run of a session, with outputs in ephys time if
+        synced, or in harp time only otherwise.
+        '''
+        self._set_status(animal_ID, session_ID, 'done' if synced else 'done_harp_time')
+
+    def mark_failed(self, animal_ID, session_ID, message):
+        '''
+        Record a failed run of a session, with the error message.
+        '''
+        self._set_status(animal_ID, session_ID, 'failed', message)
+
+    def get_status(self, animal_ID = None):
+        '''
+        Returns a list of (animal_ID, session_ID, status, pipeline_version,
+        updated_at, message) of all sessions, or of the sessions of one animal.
+        '''
+        query = 'SELECT animal_ID, session_ID, status, pipeline_version, updated_at, message FROM sessions'
+        if animal_ID is None:
+            return self.connection.execute(query + ' ORDER BY animal_ID, session_ID').fetchall()
+        return self.connection.execute(query + ' WHERE animal_ID = ? ORDER BY session_ID', (animal_ID,)).fetchall()
+
+    def get_status_counts(self):
+        '''
+        Returns a dictionary with the number of sessions in each status.
+        '''
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM sessions GROUP BY status').fetchall())
@@ -0,0 +1,230 @@
+import numpy as np
+import pandas as pd
+
+# -----------------------------------------------------------------------------
+# Unified event log of all harp streams
+# -----------------------------------------------------------------------------
+
+# Types of events in the event log
+EVENT_TYPES = [
+    'poke_in',
+    'poke_out',
+    'sound_on',
+    'sound_off',
+    'ttl_on',
+    'ttl_off',
+    'photodiode_on',
+    'photodiode_off',
+]
+
+def get_poke_stream(poke_events):
+    """
+    Get nose poke in and out events from the poke events data frame.
+
+    Args:
+        poke_events (pd.DataFrame): Indexed by timestamp, with boolean columns DIPort0, DIPort1, ...
+            giving the state of each port.
+
+    Returns:
+        tuple: timestamps, event types and port IDs of all poke events, sorted by time.
+    """
+    times, types, ports = [], [], []
+    t = poke_events.index.to_numpy(dtype=float)
+    for column in [c for c in poke_events.columns if str(c).startswith('DIPort')]:
+        state = poke_events[column].to_numpy(dtype=bool)
+        previous = np.r_[False, state[:-1]]
+        for event_type, idx in [('poke_in', np.flatnonzero(state & ~previous)), ('poke_out', np.flatnonzero(~state & previous))]:
+            times.append(t[idx])
+            types.append(np.full(len(idx), EVENT_TYPES.index(event_type), dtype=np.int8))
+            ports.append(np.full(len(idx), int(column[len('DIPort'):]), dtype=np.int64))
+    return merge_streams(times, types, ports)
+
+def get_sound_stream(sound_events, OFF_index=18):
+    """
+    Get sound onset (any sound but silence) and offset (silence) events.
+
+    Args:
+        sound_events (pd.DataFrame): columns Time and PlaySoundOrFrequency.
+        OFF_index (int): Index of the sound played for silence.
+
+    Returns:
+        tuple: timestamps, event types and sound indices of all sound events, sorted by time.
+    """
+    sound = sound_events['PlaySoundOrFrequency'].to_numpy(dtype=np.int64)
+    event_type = np.where(sound == OFF_index, EVENT_TYPES.index('sound_off'), EVENT_TYPES.index('sound_on')).astype(np.int8)
+    return sound_events['Time'].to_numpy(dtype=float), event_type, sound
+
+def get_ttl_stream(ttl_state_df):
+    """
+    Get TTL onset and offset events.
+
+    Args:
+        ttl_state_df (pd.DataFrame): columns timestamp and state (1 for onset, 0 for offset).
+
+    Returns:
+        tuple: timestamps, event types and TTL states of all TTL events, sorted by time.
+    """
+    state = ttl_state_df['state'].to_numpy(dtype=np.int64)
+    event_type = np.where(state == 1, EVENT_TYPES.index('ttl_on'), EVENT_TYPES.index('ttl_off')).astype(np.int8)
+    return ttl_state_df['timestamp'].to_numpy(dtype=float), event_type, state
+
+def get_photodiode_stream(photodiode_data, threshold=None):
+    """
+    Get photodiode flips, i.e. crossings of the analog signal through a threshold.
+
+    Args:
+        photodiode_data (pd.DataFrame): Indexed by timestamp, with column AnalogInput0.
+        threshold (float): Signal threshold. Defaults to halfway between the 1st and 99th percentiles of the signal.
+
+    Returns:
+        tuple: timestamps, event types and signal values (after the flip) of all photodiode flips, sorted by time.
+    """
+    signal = photodiode_data['AnalogInput0'].to_numpy()
+    if threshold is None:
+        low, high = np.percentile(signal, [1, 99])
+        threshold = (low + high) / 2
+
+    above = signal > threshold
+    idx = np.flatnonzero(above[1:] != above[:-1]) + 1
+    event_type = np.where(above[idx], EVENT_TYPES.index('photodiode_on'), EVENT_TYPES.index('photodiode_off')).astype(np.int8)
+    return photodiode_data.index.to_numpy(dtype=float)[idx], event_type, signal[idx].astype(np.int64)
+
+def merge_streams(times, types, values):
+    """
+    Merge event streams into a single stream sorted by time.
+
+    Each stream is already sorted, so a stable argsort of the concatenated
+    streams (timsort, which merges presorted runs) is a k-way merge. Events
+    with equal timestamps keep the order of the streams.
+
+    Args:
+        times, types, values (lists of np.ndarray): Timestamps, event types and values of each stream.
+
+    Returns:
+        tuple: timestamps, event types and values of the merged stream.
+    """
+    times, types, values = np.concatenate(times), np.concatenate(types), np.concatenate(values)
+    order = np.argsort(times, kind='stable')
+    return times[order], types[order], values[order]
+
+def check_trial_start_times(trial_start_times):
+    """
+    Check that trial start times can be searched to assign events to trials.
+
+    Args:
+        trial_start_times (array-like): Harp timestamps of trial starts.
+
+    Returns:
+        np.ndarray: Trial start times, as floats.
+
+    Raises:
+        ValueError: If any trial start time is NaN, or they are not sorted.
+    """
+    trial_start_times = np.asarray(trial_start_times, dtype=float)
+    if np.isnan(trial_start_times).any():
+        raise ValueError(f'{np.count_nonzero(np.isnan(trial_start_times))} trial start times are NaN.')
+    decreasing = np.flatnonzero(trial_start_times[1:] < trial_start_times[:-1]) + 1
+    if len(decreasing):
+        raise ValueError(f'Trial start times are not sorted: they decrease at {len(decreasing)} trials (first at trial {decreasing[0]}).')
+    return trial_start_times
+
+def get_event_log(poke_events, sound_events, ttl_state_df, photodiode_data, trial_start_times=None, tm=None, OFF_index=18, photodiode_threshold=None):
+    """
+    Merge all harp event streams of a session into a single event log sorted by time.
+
+    Args:
+        poke_events (pd.DataFrame): Poke events (see harp_session.poke_events).
+        sound_events (pd.DataFrame): Sound events (see harp_session.sound_events).
+        ttl_state_df (pd.DataFrame): TTL events (see harp_session.ttl_state_df).
+        photodiode_data (pd.DataFrame): Photodiode signal (see harp_session.photodiode_data).
+        trial_start_times (array-like): Harp timestamps of trial starts, used to assign events to trials.
+            Must be sorted and without NaNs (see check_trial_start_times).
+        tm (timestamp_mapping): Harp to ephys timestamp mapping. If None, ephys timestamps are NaN.
+        OFF_index (int): Index of the sound played for silence.
+        photodiode_threshold (float): Threshold of photodiode flips (see get_photodiode_stream).
+
+    Returns:
+        pd.DataFrame: One row per event, with columns:
+            - harp_timestamp: timestamp of the event in the harp clock.
+            - ephys_timestamp: timestamp of the event in the ephys clock.
+            - event_type: categorical, one of EVENT_TYPES.
+            - value: port ID for poke events, sound index for sound events, TTL state for TTL
+              events and signal value for photodiode events.
+            - trial: index of the trial the event occured in (trials last until the start of the
+              next trial), or -1 before the first trial.
+
+    Raises:
+        ValueError: If trial_start_times are not sorted or contain NaNs.
+    """
+    streams = [
+        get_poke_stream(poke_events),
+        get_sound_stream(sound_events, OFF_index),
+        get_ttl_stream(ttl_state_df),
+        get_photodiode_stream(photodiode_data, photodiode_threshold),
+    ]
+    times, types, values = merge_streams(*zip(*streams))
+
+    if trial_start_times is None:
+        trial = np.full(len(times), -1, dtype=np.int64)
+    else:
+        trial = np.searchsorted(check_trial_start_times(trial_start_times), times, side='right') - 1
+
+    return pd.DataFrame({
+        'harp_timestamp': times,
+        'ephys_timestamp': np.full(len(times), np.nan) if tm is None else tm.get_pxie_timestamp(times),
+        'event_type': pd.Categorical.from_codes(types, categories=EVENT_TYPES),
+        'value': values,
+        'trial': trial,
+    })
+
+class event_log_index():
+    '''
+    Index of an event log (see get_event_log) answering "all events between
+    t0 and t1" and "events of type X in trial k" with binary searches, in
+    O(log N + k) for k matching events. Queries return the rows of the event
+    log, sorted by time.
+    '''
+    def __init__(self, event_log, trial_start_times=None, time_column='harp_timestamp'):
+
+        self.event_log = event_log
+        self.time_column = time_column
+        self.times = event_log[time_column].to_numpy(dtype=float)
+        self.trial_start_times = None if trial_start_times is None else check_trial_start_times(trial_start_times)
+
+        # Positions of the events of each type, in time order
+        codes = event_log['event_type'].cat.codes.to_numpy()
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(EVENT_TYPES) + 1))
+        self.type_positions = {
+            event_type: order[bounds[i]:bounds[i + 1]] for i, event_type in enumerate(EVENT_TYPES)
+        }
+        self.type_times = {
+            event_type: self.times[positions] for event_type, positions in self.type_positions.items()
+        }
+
+    def get_events(self, t_start, t_end, event_type=None):
+        '''
+        Returns all events (of a given type, if specified) with t_start <= time < t_end.
+        '''
+        if event_type is None:
+            lo, hi = np.searchsorted(self.times, [t_start, t_end])
+            return self.event_log.iloc[lo:hi]
+
+        if event_type not in self.type_positions:
+            raise ValueError(f"Invalid event type '{event_type}'. Must be one of {EVENT_TYPES}.")
+        lo, hi = np.searchsorted(self.type_times[event_type], [t_start, t_end])
+        return self.event_log.iloc[self.type_positions[event_type][lo:hi]]
+
+    def get_trial_events(self, trial, event_type=None):
+        '''
+        Returns all events (of a given type, if specified) in a trial. Trials
+        last until the start of the next trial (or forever, for the last trial).
+        '''
+        if self.trial_start_times is None:
+            raise ValueError('No trial start times given to index trials.')
+        if self.time_column != 'harp_timestamp':
+            raise ValueError('Trial start times are in harp time, so trials can only be queried on harp_timestamp.')
+
+        t_start = self.trial_start_times[trial]
+        t_end = self.trial_start_times[trial + 1] if trial + 1 < len(self.trial_start_times) else np.inf
+        return self.get_events(t_start, t_end, event_type)
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+# -----------------------------------------------------------------------------
+# Schema of experimental-data.csv (Bonsai trial-level outputs)
+# -----------------------------------------------------------------------------
+
+# Declared columns and their dtypes. Other columns are read as text and
+# carried through unchanged.
+EXPERIMENTAL_DATA_SCHEMA = {
+    'TrialNumber': 'Int64',
+    'TrialStart': 'float64',
+    'TrialEnd': 'float64',
+    'TrainingStage': 'Int64',
+    'TrainingSubstage': 'str',
+    'TrialCompletionCode': 'str',
+    'DotXLocation': 'float64',
+    'DotYLocation': 'float64',
+    'DotOnsetTime': 'float64',
+    'DotOffsetTime': 'float64',
+    'AudioCueIdentity': 'Int64',
+    'AudioCueStart': 'float64',
+    'AudioCueEnd': 'float64',
+    'NosepokeInTime': 'float64',
+}
+
+# Columns converted to categoricals after reading, with categories of the
+# dtype of the schema (e.g. integer cue identities stay integers)
+CATEGORICAL_COLUMNS = ['TrainingSubstage', 'TrialCompletionCode', 'AudioCueIdentity']
+
+# Columns that must be present
+REQUIRED_COLUMNS = ['TrialNumber', 'TrialStart', 'TrialEnd', 'TrialCompletionCode']
+
+# Columns timestamped by Bonsai in the harp clock
+TIMESTAMP_COLUMNS = [
+    'TrialStart',
+    'TrialEnd',
+    'DotOnsetTime',
+    'DotOffsetTime',
+    'AudioCueStart',
+    'AudioCueEnd',
+    'NosepokeInTime'
+]
+
+# Names of columns in other versions of the Bonsai workflow, mapped to their
+# name in the schema
+COLUMN_ALIASES = {
+    'AudioCueOnsetTime': 'AudioCueStart',
+    'AudioCueOffsetTime': 'AudioCueEnd',
+    'NosePokeInTime': 'NosepokeInTime',
+}
+
+# Tolerance (s) of timestamps outside the time range of the harp streams
+RANGE_TOLERANCE = 1.0
+
+def read_experimental_data(experimental_data_path, harp_time_range=None, schema=EXPERIMENTAL_DATA_SCHEMA, aliases=COLUMN_ALIASES):
+    """
+    Read experimental-data.csv with a fixed schema: the declared columns are
+    read with fixed dtypes, and column aliases from other versions of the
+    Bonsai workflow are renamed to their name in the schema. Columns in
+    CATEGORICAL_COLUMNS are then converted to categoricals. All other columns
+    are read as text and carried through unchanged, so that they are written
+    back as in the file. The timestamps are validated (see
+    validate_experimental_data).
+
+    Args:
+        experimental_data_path (str): Path to experimental-data.csv.
+        harp_time_range (tuple): (start, end) of the harp streams of the session, in harp time.
+            If given, all timestamps must lie within it.
+        schema (dict): Maps column names to dtypes.
+        aliases (dict): Maps alternative column names to their name in the schema.
+            Columns that are neither in the schema nor aliases are read as text.
+
+    Returns:
+        pd.DataFrame: Trials, with the columns of the schema present in the file, in schema order,
+            followed by all other columns, in file order.
+
+    Raises:
+        ValueError: If a required column is missing, a column appears under several aliases, a value
+            cannot be parsed with its dtype, or the timestamps are invalid.
+    """
+    # Map columns in the file to their name in the schema
+    header = pd.read_csv(experimental_data_path, nrows=0).columns
+    rename = {}
+    for column in header:
+        name = aliases.get(column, column)
+        if name not in schema:
+            continue
+        if name in rename.values():
+            raise ValueError(f"Column '{name}' appears more than once (as aliases) in {experimental_data_path}.")
+        rename[column] = name
+
+    missing = [column for column in REQUIRED_COLUMNS if column not in rename.values()]
+    if missing:
+        raise ValueError(f"Missing required columns {missing} in {experimental_data_path}.")
+
+    # Columns not in the schema are kept as text, so they are not reformatted
+    other_columns = [column for column in header if column not in rename]
+    dtype = {column: schema[name] for column, name in rename.items()}
+    dtype.update({column: 'str' for column in other_columns})
+    trials_df = pd.read_csv(experimental_data_path, dtype=dtype, engine='c')
+    trials_df = trials_df.rename(columns=rename)
+    trials_df = trials_df[[column for column in schema if column in trials_df.columns] + other_columns]
+    for column in [column for column in CATEGORICAL_COLUMNS if column in trials_df.columns]:
+        trials_df[column] = trials_df[column].astype('category')
+
+    validate_experimental_data(trials_df, harp_time_range, experimental_data_path)
+
+    return trials_df
+
+def validate_experimental_data(trials_df, harp_time_range=None, experimental_data_path=''):
+    """
+    Check the Bonsai timestamps of experimental-data.csv: trial start times are
+    present and monotonic, trials do not end before they start, and (if a harp
+    time range is given) all timestamps lie within the time range of the harp
+    streams of the session.
+
+    Args:
+        trials_df (pd.DataFrame): Trials (see read_experimental_data).
+        harp_time_range (tuple): (start, end) of the harp streams of the session, in harp time.
+        experimental_data_path (str): Path to experimental-data.csv, for error messages.
+
+    Raises:
+        ValueError: Listing every failed check.
+    """
+    errors = []
+
+    trial_start = trials_df['TrialStart'].to_numpy()
+    trial_end = trials_df['TrialEnd'].to_numpy()
+
+    n_missing = np.count_nonzero(np.isnan(trial_start))
+    if n_missing:
+        errors.append(f"{n_missing} trials without TrialStart")
+
+    decreasing = np.flatnonzero(trial_start[1:] < trial_start[:-1]) + 1
+    if len(decreasing):
+        errors.append(f"TrialStart decreases at {len(decreasing)} trials (first at row {decreasing[0]})")
+
+    ends_before_start = np.flatnonzero(trial_end < trial_start)
+    if len(ends_before_start):
+        errors.append(f"TrialEnd is before TrialStart in {len(ends_before_start)} trials (first at row {ends_before_start[0]})")
+
+    if harp_time_range is not None:
+        columns = [column for column in TIMESTAMP_COLUMNS if column in trials_df.columns]
+        timestamps = trials_df[columns].to_numpy(dtype=float)
+        outside = (timestamps < harp_time_range[0] - RANGE_TOLERANCE) | (timestamps > harp_time_range[1] + RANGE_TOLERANCE)
+        for column, n_outside in zip(columns, outside.sum(axis=0)):
+            if n_outside:
+                errors.append(f"{n_outside} {column} timestamps outside the harp streams ({harp_time_range[0]:.3f} to {harp_time_range[1]:.3f} s)")
+
+    if errors:
+        raise ValueError(f"Invalid experimental data {experimental_data_path}: " + '; '.join(errors))
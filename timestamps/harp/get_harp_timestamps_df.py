@@ -1,10 +1,11 @@
-import harp
-import pandas as pd
 import os
-import matplotlib.pyplot as plt
 
 # Import custom functions
 import timestamps.harp.utils as hu
+import timestamps.harp.event_log as el
+import timestamps.harp.validation as hv
+import timestamps.harp.experimental_data as ed
+from timestamps.aligned_outputs import save_stream
 import timestamps.utils.plot_utils as pu
                 
 # ----------------------------------------------------------------------------------
@@ -30,7 +31,7 @@ SOUND_MAPPING = {
 
 class harp_session():
 
-    def __init__(self, animal_ID, session_ID, raw_data_dir = RAW_DATA_ROOT_DIR, output_dir = OUTPUT_ROOT_DIR, sound_mapping  = SOUND_MAPPING): 
+    def __init__(self, animal_ID, session_ID, raw_data_dir = RAW_DATA_ROOT_DIR, output_dir = OUTPUT_ROOT_DIR, sound_mapping  = SOUND_MAPPING, decode = True): 
 
         raw_data_session_dir = os.path.join(raw_data_dir, animal_ID, session_ID)
         output_session_dir = os.path.join(output_dir, animal_ID, session_ID)
@@ -45,6 +46,9 @@ class harp_session():
         self.raw_data_root_dir = raw_data_dir
         self.output_root_dir = output_dir
 
+        # Import harp only when a session is loaded
+        import harp
+
         # Create reader for behavior from behavior binary files
         bin_b_path = os.path.join(
             raw_data_dir, 
@@ -80,17 +84,26 @@ class harp_session():
         # Append data from harp events and Bonsai .csv outputs to harp session
         #==============================================================================
 
-        # Read the harp sound card stream, for the timestamps and audio ID
-        self.sound_events = hu.get_all_sounds(bin_sound_path)
+        # Decoding can be skipped when the data streams are set from elsewhere
+        # (e.g. pipeline checkpoints)
+        if decode:
+
+            # Read the harp sound card stream, for the timestamps and audio ID
+            self.sound_events = hu.get_all_sounds(bin_sound_path)
 
-        # Read in harp binaries to get photodiode data series
-        self.photodiode_data = hu.get_photodiode_data(behavior_reader)
+            # Read in harp binaries to get photodiode data series
+            self.photodiode_data = hu.get_photodiode_data(behavior_reader)
 
-        # Read in harp binaries to get poke events data frame
-        self.poke_events = hu.get_all_pokes(behavior_reader)
+            # Read in harp binaries to get poke events data frame
+            self.poke_events = hu.get_all_pokes(behavior_reader)
 
-        # Read in Bonsai .csv file with trial-level information as a pandas DataFrame
-        self.trials_df = pd.read_csv(experimental_data_path)
+            # Read in Bonsai .csv file with trial-level information as a pandas DataFrame,
+            # checking its timestamps lie within the harp streams
+            harp_time_range = (
+                min(self.photodiode_data.index.min(), self.poke_events.index.min(), self.sound_events['Time'].min()),
+                max(self.photodiode_data.index.max(), self.poke_events.index.max(), self.sound_events['Time'].max())
+            )
+            self.trials_df = ed.read_experimental_data(experimental_data_path, harp_time_range)
 
         #==============================================================================
         # Create output directories
@@ -100,6 +113,10 @@ class harp_session():
         os.makedirs(output_session_dir, exist_ok = True)
 
     def save_harp_data_streams(self):
+        '''
+        Saves the poke events, photodiode data and sound events as .csv and as
+        binary streams (see save_stream). Returns the paths of the files written.
+        '''
 
         # Save poke events data frame as .csv
         poke_events_filename = self.animal_ID + '_' + self.session_ID + '_' + 'poke_events.csv'
@@ -115,30 +132,90 @@ class harp_session():
         sound_events_filename = self.animal_ID + '_' + self.session_ID + '_' + 'sound_events.csv'
         sound_events_filepath = os.path.join(self.output_session_dir, sound_events_filename)
         self.sound_events.to_csv(sound_events_filepath, index = False)
-        
+
+        # Save binary copies of the data streams, to read time ranges without loading whole files
+        paths = [poke_events_filepath, photodiode_filepath, sound_events_filepath]
+        paths += save_stream(self.output_session_dir, 'poke_events', *hu.get_stream_columns(self.poke_events))
+        paths += save_stream(self.output_session_dir, 'photodiode_data', *hu.get_stream_columns(self.photodiode_data))
+        paths += save_stream(self.output_session_dir, 'sound_events', *hu.get_stream_columns(self.sound_events, 'Time'))
+        return paths
+
     def save_experiment_csv(self):
 
         trials_filename = self.animal_ID + '_' + self.session_ID + '_experimental-data_ephys-timestamps.csv'
         trials_filepath = os.path.join(self.output_session_dir, trials_filename)
         self.trials_df_ephys.to_csv(trials_filepath)
+        return trials_filepath
     
+    def validate_streams(self):
+        '''
+        Checks the timestamps of all decoded harp streams (and of the raw TTL
+        set and clear events) for non-monotonic or duplicated timestamps, gaps
+        in AnalogData and TTL set/clear alternation breaks. Saves the report as .csv and returns it. Requires read_ttl.
+        '''
+        self.stream_validation = hv.validate_streams(
+            self.poke_events,
+            self.photodiode_data,
+            self.ttl_state_df,
+            self.sound_events,
+            self.ttl_set_times,
+            self.ttl_clear_times
+        )
+        self.stream_validation.to_csv(os.path.join(self.output_session_dir, 'harp_stream_validation.csv'))
+        return self.stream_validation
+
+    def get_event_log(self, tm = None):
+        '''
+        Merges poke, sound, TTL and photodiode events into a single event log
+        sorted by time (self.event_log), with ephys timestamps if a harp to
+        ephys timestamp mapping is given, and an index to query it by time
+        range, event type and trial (self.event_index). Requires read_ttl.
+        '''
+        trial_start_times = self.trials_df['TrialStart'].to_numpy()
+        self.event_log = el.get_event_log(
+            self.poke_events,
+            self.sound_events,
+            self.ttl_state_df,
+            self.photodiode_data,
+            trial_start_times = trial_start_times,
+            tm = tm,
+            OFF_index = self.sound_mapping['soundOffIdx']
+        )
+        self.event_index = el.event_log_index(self.event_log, trial_start_times)
+
+    def save_event_log(self):
+
+        # Save event log data frame as .csv
+        event_log_filename = self.animal_ID + '_' + self.session_ID + '_' + 'event_log.csv'
+        event_log_filepath = os.path.join(self.output_session_dir, event_log_filename)
+        self.event_log.to_csv(event_log_filepath, index = False)
+
+        # Save binary copy of the event log
+        paths = save_stream(self.output_session_dir, 'event_log', *hu.get_stream_columns(self.event_log, 'harp_timestamp'))
+        return [event_log_filepath] + paths
+
     def import_behavioral_data(self):
 
         # Import behavioral data as data frame
         session_path = os.path.join(RAW_DATA_ROOT_DIR,self.animal_ID,self.session_ID)
         filepath = os.path.join(session_path,'Experimental-data' ,(self.session_ID + '_experimental-data.csv'))
         print(filepath)
-        self.trials_df = pd.read_csv(filepath)
+        self.trials_df = ed.read_experimental_data(filepath)
 
-    def read_ttl(self):
+    def read_ttl(self, save_csv = True):
 
-        self.ttl_state_df = hu.get_ttl_state_df(self.behavior_reader)
-        self.ttl_state_df.to_csv(os.path.join(self.output_session_dir, 'TTLs_harp.csv'))
+        # Raw set and clear timestamps are kept to validate them before sorting
+        self.ttl_set_times, self.ttl_clear_times = hu.get_ttl_set_clear_times(self.behavior_reader)
+        self.ttl_state_df = hu.get_ttl_state_df(self.behavior_reader, (self.ttl_set_times, self.ttl_clear_times))
+        if save_csv:
+            self.ttl_state_df.to_csv(os.path.join(self.output_session_dir, 'TTLs_harp.csv'))
 
     def plot_ttl(self, seconds = 20):
         '''
         Plots the ttl signal for the first ·seconds· seconds
         '''
+        import matplotlib.pyplot as plt
+
         # Plot ttl trace
         plt.figure(figsize=(12, 6))  # Set the figure size (width, height) in inches
         ttl_pulse = pu.get_square_wave(self.ttl_state_df)
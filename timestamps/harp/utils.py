@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-import harp
 import os
 
 # -----------------------------------------------------------------------------
@@ -85,29 +84,46 @@ def get_experimental_data(root_dir):
 # TTL utils
 # -----------------------------------------------------------------------------
 
-# Get a data frame with timestamps of all instances of initiating and 
-# terminating a TTL pulse
-def get_ttl_state_df(behavior_reader):
+# Get timestamps of all instances of initiating and terminating a TTL pulse,
+# in the order they were recorded
+def get_ttl_set_clear_times(behavior_reader):
 
-  # Get data frame with timestamps of all instances of initiating TTL pulse
+    # Timestamps of all instances of initiating TTL pulse
     ttl_on  = behavior_reader.OutputSet.read(keep_type=True)['DO2']
     ttl_on = ttl_on[ttl_on==True]
+
+    # Timestamps of all instances of terminating a TTL pulse
+    ttl_off = behavior_reader.OutputClear.read(keep_type=True)['DO2']
+    ttl_off = ttl_off[ttl_off==True]
+
+    return ttl_on.index.to_numpy(), ttl_off.index.to_numpy()
+
+# Get a data frame with timestamps of all instances of initiating and 
+# terminating a TTL pulse. ttl_times are the set and clear timestamps (see
+# get_ttl_set_clear_times), read from behavior_reader if not given.
+def get_ttl_state_df(behavior_reader, ttl_times = None):
+
+    if ttl_times is None:
+        ttl_times = get_ttl_set_clear_times(behavior_reader)
+    ttl_set_times, ttl_clear_times = ttl_times
+
+    # Get data frame with timestamps of all instances of initiating TTL pulse
     ttl_on_df = pd.DataFrame({
-        'timestamp': ttl_on.index,
+        'timestamp': ttl_set_times,
         'state': 1
     })
 
     # Get data frame with timestamps of all instances of terminating a TTL pulse
-    ttl_off = behavior_reader.OutputClear.read(keep_type=True)['DO2']
-    ttl_off = ttl_off[ttl_off==True]
     ttl_off_df = pd.DataFrame({
-        'timestamp': ttl_off.index,
+        'timestamp': ttl_clear_times,
         'state': 0
     })
 
     # Concatenate data frames into single stream of events describing state of TTL
     ttl_state_df = pd.concat([ttl_on_df,ttl_off_df], ignore_index=True)
-    ttl_state_df = ttl_state_df.sort_values(by='timestamp')
+    # Stable sort, so that set and clear events with the same timestamp keep a
+    # deterministic order (see timestamps.harp.validation to detect them)
+    ttl_state_df = ttl_state_df.sort_values(by='timestamp', kind='stable')
     ttl_state_df = ttl_state_df.reset_index(drop=True)
     
     return ttl_state_df
@@ -309,7 +325,10 @@ def get_port_choice(trials_df, behavior_reader):
 # -----------------------------------------------------------------------------
 
 def get_all_sounds(bin_sound_path):
-    
+
+    # Import harp only when reading binary files
+    import harp
+
     # the explicitly defined model will be deprecated or redundant in future
     model = harp.model.Model(
         device='Soundcard',
@@ -388,4 +407,35 @@ def get_photodiode_data(behavior_reader):
     # Keep only Time and AnalogInput0 columns
     photodiode_data = pd.DataFrame(photodiode_data['AnalogInput0'])
 
-    return photodiode_data
\ No newline at end of file
+    return photodiode_data
+
+# -----------------------------------------------------------------------------
+# Output utils
+# -----------------------------------------------------------------------------
+
+def get_stream_columns(df, time_column=None):
+    """
+    Convert a data frame of a harp data stream to columns of arrays, to be saved
+    with timestamps.aligned_outputs.save_stream.
+
+    Args:
+        df (pd.DataFrame): Data stream.
+        time_column (str): Column with harp timestamps. If None, the index is used.
+
+    Returns:
+        tuple:
+            - dict: Maps column names to arrays, with harp timestamps as 'harp_timestamp'.
+            - dict: Maps names of categorical columns (as integer codes) to their categories.
+    """
+    harp_timestamp = df.index if time_column is None else df[time_column]
+    columns = {'harp_timestamp': np.asarray(harp_timestamp, dtype=float)}
+    categories = {}
+    for name in df.columns:
+        if name == time_column:
+            continue
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            columns[name] = df[name].cat.codes.to_numpy()
+            categories[name] = [str(c) for c in df[name].cat.categories]
+        else:
+            columns[name] = df[name].to_numpy()
+    return columns, categories
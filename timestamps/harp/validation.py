@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+# -----------------------------------------------------------------------------
+# Integrity checks of harp stream timestamps
+# -----------------------------------------------------------------------------
+
+# Intervals longer than GAP_FACTOR times the sample period of a regularly
+# sampled stream (AnalogData) are counted as gaps
+GAP_FACTOR = 1.5
+
+def check_timestamps(timestamps, sample_period=None, gap_factor=GAP_FACTOR):
+    """
+    Check the timestamps of a single stream in one pass over their differences.
+
+    Args:
+        timestamps (array-like): Timestamps of the stream (s), in the order they were recorded.
+        sample_period (float or str): Expected interval between samples (s) of a regularly sampled
+            stream, 'auto' to use the median interval, or None for event streams (no gap check).
+        gap_factor (float): Intervals longer than gap_factor * sample_period are counted as gaps.
+
+    Returns:
+        dict: Number of samples, number of non-monotonic and duplicated timestamps, and for regularly
+            sampled streams the sample period, number of gaps and longest gap (ms).
+    """
+    t = np.asarray(timestamps, dtype=float)
+    d = np.diff(t)
+
+    report = {
+        'n_samples': len(t),
+        'non_monotonic': int(np.count_nonzero(d < 0)),
+        'duplicated': int(np.count_nonzero(d == 0)),
+        'sample_period_ms': np.nan,
+        'gaps': 0,
+        'max_gap_ms': np.nan,
+    }
+
+    if sample_period is not None and len(d) > 0:
+        if sample_period == 'auto':
+            sample_period = np.median(d)
+        gaps = d > gap_factor * sample_period
+        report['sample_period_ms'] = sample_period * 1e3
+        report['gaps'] = int(np.count_nonzero(gaps))
+        report['max_gap_ms'] = d[gaps].max() * 1e3 if report['gaps'] else 0.0
+
+    return report
+
+def validate_streams(poke_events, photodiode_data, ttl_state_df, sound_events, ttl_set_times, ttl_clear_times, analog_sample_period='auto', gap_factor=GAP_FACTOR):
+    """
+    Validate the timestamps of all decoded harp streams of a session: detect non-monotonic or
+    duplicated timestamps in every stream, unexpected gaps in the sampling of AnalogData, and
+    breaks in the alternation of TTL set (OutputSet) and clear (OutputClear) events.
+
+    Args:
+        poke_events (pd.DataFrame): DigitalInputState events, indexed by timestamp.
+        photodiode_data (pd.DataFrame): AnalogData samples, indexed by timestamp.
+        ttl_state_df (pd.DataFrame): TTL set (state 1) and clear (state 0) events, with columns
+            timestamp and state, sorted by timestamp.
+        sound_events (pd.DataFrame): PlaySoundOrFrequency events, with column Time.
+        ttl_set_times (array-like): Timestamps of TTL set (OutputSet DO2) events, in the order they
+            were recorded, i.e. before sorting (see harp.utils.get_ttl_set_clear_times).
+        ttl_clear_times (array-like): Timestamps of TTL clear (OutputClear DO2) events, in the order
+            they were recorded.
+        analog_sample_period (float or str): Expected sample period of AnalogData (s), or 'auto'
+            to use the median interval.
+        gap_factor (float): Intervals longer than gap_factor * sample period are counted as gaps.
+
+    Returns:
+        pd.DataFrame: One row per stream, with the columns of check_timestamps, the number of
+            alternation errors (TTL events with the same state as the previous event, -1 if not
+            applicable), and 'passed', which is False if any problem was found. The set and clear
+            events are checked as recorded (OutputSet (DO2), OutputClear (DO2)), and merged and
+            sorted (OutputSet/OutputClear (DO2)) for duplicates between them and alternation.
+    """
+    reports = {
+        'DigitalInputState': check_timestamps(poke_events.index),
+        'AnalogData': check_timestamps(photodiode_data.index, analog_sample_period, gap_factor),
+        'OutputSet (DO2)': check_timestamps(ttl_set_times),
+        'OutputClear (DO2)': check_timestamps(ttl_clear_times),
+        'OutputSet/OutputClear (DO2)': check_timestamps(ttl_state_df['timestamp']),
+        'PlaySoundOrFrequency': check_timestamps(sound_events['Time']),
+    }
+    report = pd.DataFrame.from_dict(reports, orient='index')
+    report.index.name = 'stream'
+
+    state = ttl_state_df['state'].to_numpy()
+    report['alternation_errors'] = -1
+    report.loc['OutputSet/OutputClear (DO2)', 'alternation_errors'] = int(np.count_nonzero(state[1:] == state[:-1]))
+
+    report['passed'] = (
+        (report['non_monotonic'] == 0)
+        & (report['duplicated'] == 0)
+        & (report['gaps'] == 0)
+        & (report['alternation_errors'] <= 0)
+    )
+
+    return report
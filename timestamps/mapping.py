@@ -0,0 +1,436 @@
+from os.path import join
+import json
+import pickle
+
+import numpy as np
+
+# -----------------------------------------------------------------------------
+# Lightweight mappings between clocks. This module only imports NumPy, so that
+# jobs which only load and apply saved mappings start quickly. Heavy
+# dependencies (e.g. matplotlib) are imported inside the functions that need
+# them. Keep it that way: benchmarks/bench_import_time.py checks it.
+# -----------------------------------------------------------------------------
+
+# Maximum distance between paired pulses of two clocks, as a fraction of the
+# median interval between pulses
+PAIRING_TOLERANCE = 0.25
+
+# Number of pulses at the start of each clock tried as anchors of the pairing
+PAIRING_ANCHORS = 10
+
+# Residual (s) below which pulse pairs are counted to score a pairing
+PAIRING_MAX_RESIDUAL = 1e-3
+
+def _nearest(sorted_values, values):
+    # Index of the nearest element of sorted_values to each value
+    if len(sorted_values) == 1:
+        return np.zeros(len(values), dtype=np.int64)
+    right = np.searchsorted(sorted_values, values).clip(1, len(sorted_values) - 1)
+    left = right - 1
+    return np.where(values - sorted_values[left] <= sorted_values[right] - values, left, right)
+
+def _match_nearest(x, y, slope, intercept, tolerance):
+    # Mutual nearest neighbours of slope * x + intercept and y, within tolerance
+    predicted = slope * x + intercept
+    y_idx = _nearest(y, predicted)
+    x_idx = np.arange(len(x))
+    keep = (_nearest(predicted, y)[y_idx] == x_idx) & (np.abs(y[y_idx] - predicted) <= tolerance)
+    return x_idx[keep], y_idx[keep]
+
+# Pair pulses recorded by two clocks
+def pair_timestamps(x, y, tolerance = PAIRING_TOLERANCE, n_anchors = PAIRING_ANCHORS, max_residual = PAIRING_MAX_RESIDUAL):
+    """
+    Pair the timestamps of the same pulses recorded by two clocks, when either
+    clock may have missed pulses or recorded extra (glitched) ones.
+
+    Pulses are paired with their mutual nearest neighbour in the other clock
+    within `tolerance` times the median interval between pulses. Every offset
+    between one of the first n_anchors pulses of each clock is tried as an
+    initial estimate of the mapping (with slope 1): pulses are paired, the
+    slope and intercept re-estimated from the pairs (median of slopes, see
+    robust_linear_fit) to correct for clock drift, and the estimate scored by
+    the number of pairs within max_residual of it. Pulses are then paired with
+    the best estimate. Ties are broken in favour of pairing pulses by index,
+    which is the only option for a perfectly regular pulse train missing
+    pulses at its start.
+
+    Parameters:
+    x (np.ndarray): Sorted timestamps in the source clock (s).
+    y (np.ndarray): Sorted timestamps in the target clock (s).
+    tolerance (float): Maximum distance between paired pulses, as a fraction of the median interval between pulses.
+    n_anchors (int): Number of pulses at the start of each clock tried as anchors.
+    max_residual (float): Residual (s) below which pairs are counted to score an estimate.
+
+    Returns:
+    tuple of np.ndarray: Indices into x and y of the paired pulses.
+
+    Raises:
+    ValueError: If there are fewer than two pulses in either clock.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if len(x) < 2 or len(y) < 2:
+        raise ValueError('At least two pulses are needed in each clock to pair them.')
+    tolerance = tolerance * np.median(np.diff(x))
+
+    # Candidate offsets, ordered so that pairing by index comes first
+    i, j = np.meshgrid(np.arange(min(n_anchors, len(x))), np.arange(min(n_anchors, len(y))), indexing='ij')
+    order = np.argsort(np.abs(i - j).ravel(), kind='stable')
+    offsets = (y[j.ravel()] - x[i.ravel()])[order]
+    best_score, best_fit = -1, None
+    for offset in offsets:
+        x_idx, y_idx = _match_nearest(x, y, 1.0, offset, tolerance)
+        if len(x_idx) < 2:
+            continue
+        # Correct for clock drift, and score by the pairs that fit the line
+        slope, intercept = _median_slope_fit(x[x_idx], y[y_idx])
+        score = np.count_nonzero(np.abs(y[y_idx] - (slope * x[x_idx] + intercept)) <= max_residual)
+        if score > best_score:
+            best_score, best_fit = score, (slope, intercept)
+
+    if best_fit is None:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return _match_nearest(x, y, *best_fit, tolerance)
+
+def _median_slope_fit(x, y):
+    # Median of the slopes between pairs half the data apart (which is
+    # insensitive to a minority of outliers), and the median intercept
+    half = len(x) // 2
+    dx = x[half:2 * half] - x[:half]
+    valid = dx != 0
+    slope = np.median((y[half:2 * half] - y[:half])[valid] / dx[valid]) if valid.any() else 1.0
+    intercept = np.median(y - slope * x)
+    return slope, intercept
+
+# Fit a line robustly to paired timestamps
+def robust_linear_fit(x, y, threshold = 5.0, min_residual = 1e-4, max_iter = 10):
+    """
+    Fit y = slope * x + intercept while rejecting outlier pairs.
+
+    The initial estimate is the median of the slopes between pairs half the
+    data apart (which is insensitive to a minority of outliers). The fit is
+    then refined by iteratively fitting least squares to the inliers and
+    rejecting pairs with a residual above `threshold` robust standard
+    deviations (from the median absolute deviation), until the set of
+    inliers stops changing.
+
+    Parameters:
+    x (np.ndarray): Timestamps in the source clock (s).
+    y (np.ndarray): Paired timestamps in the target clock (s).
+    threshold (float): Residual threshold, in robust standard deviations.
+    min_residual (float): Minimum residual threshold (s), so that pulses are not rejected for sub-sample jitter.
+    max_iter (int): Maximum number of refinement passes.
+
+    Returns:
+    tuple: slope (float), intercept (float) and inliers (boolean np.ndarray).
+
+    Raises:
+    ValueError: If x and y do not have the same length, or there are fewer than two pairs.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if len(x) != len(y):
+        raise ValueError(f'Cannot fit {len(x)} and {len(y)} timestamps: they must be paired.')
+    if len(x) < 2:
+        raise ValueError('At least two pulse pairs are needed to fit a mapping.')
+
+    # Initial estimate from slopes between pairs half the data apart
+    slope, intercept = _median_slope_fit(x, y)
+
+    inliers = np.ones(len(x), dtype=bool)
+    for _ in range(max_iter):
+        residuals = y - (slope * x + intercept)
+        deviation = 1.4826 * np.median(np.abs(residuals[inliers] - np.median(residuals[inliers])))
+        new_inliers = np.abs(residuals) <= max(threshold * deviation, min_residual)
+        if new_inliers.sum() < 2 or np.array_equal(new_inliers, inliers):
+            break
+        inliers = new_inliers
+
+        # Least squares on the inliers (centred for numerical stability)
+        x_mean, y_mean = x[inliers].mean(), y[inliers].mean()
+        dx, dy = x[inliers] - x_mean, y[inliers] - y_mean
+        slope = np.dot(dx, dy) / np.dot(dx, dx)
+        intercept = y_mean - slope * x_mean
+
+    return slope, intercept, inliers
+
+class timestamp_mapping():
+    '''
+    Calculates a mapping between harp and pxie timestamps. Will print
+    some diagnostic plots and be unpickled  if neccessary to map arbitrary
+    harp timestamps. With fit_method = 'robust', pulses are first paired
+    between the clocks (see pair_timestamps), so that missing or glitched
+    edges in either clock are dropped, and outlier pulse pairs are then
+    rejected before fitting (see robust_linear_fit). Otherwise ordinary
+    least squares is used on pulses paired by index ('ols'). Numeric QC of
+    the fit is stored in self.qc. harp_onset and pxie_onset need a
+    'timestamp' and a 'global_timestamp' column (or key) respectively.
+    '''
+    def __init__(self, harp_onset, pxie_onset, output_session_dir, fit_method = 'robust'):
+        self.output_session_dir = output_session_dir
+        self.fit_method = fit_method
+
+        # Keep onsets as plain arrays, so that the pickled mapping can be
+        # loaded without pandas
+        harp_timestamps = np.asarray(harp_onset['timestamp'], dtype=float)
+        pxie_timestamps = np.asarray(pxie_onset['global_timestamp'], dtype=float)
+        self.n_harp_pulses = len(harp_timestamps)
+        self.n_pxie_pulses = len(pxie_timestamps)
+
+        print(f'There are {len(harp_timestamps)} harp rises and {len(pxie_timestamps)} pxie rises')
+        if len(harp_timestamps) != len(pxie_timestamps):
+            print('CAREFUL! There does not seem to be an equal number of rise events.')
+
+        # Pair pulses, and find pulse pairs to keep for the fit
+        if fit_method == 'robust':
+            harp_idx, pxie_idx = pair_timestamps(harp_timestamps, pxie_timestamps)
+            _, _, self.inliers = robust_linear_fit(harp_timestamps[harp_idx], pxie_timestamps[pxie_idx])
+        elif fit_method == 'ols':
+            if len(harp_timestamps) != len(pxie_timestamps):
+                raise ValueError(f"Cannot fit {len(harp_timestamps)} and {len(pxie_timestamps)} timestamps with fit_method 'ols': they must be paired.")
+            harp_idx = pxie_idx = np.arange(len(harp_timestamps))
+            self.inliers = np.ones(len(harp_timestamps), dtype=bool)
+        else:
+            raise ValueError(f"Invalid fit_method '{fit_method}'. Only 'robust' and 'ols' are supported.")
+
+        # Paired pulses
+        self.harp_timestamps = harp_timestamps[harp_idx]
+        self.pxie_timestamps = pxie_timestamps[pxie_idx]
+        n_unpaired = self.n_harp_pulses + self.n_pxie_pulses - 2 * len(harp_idx)
+        if n_unpaired:
+            print(f'Dropped {n_unpaired} pulses without a match in the other clock.')
+        if self.inliers.sum() < len(self.inliers):
+            print(f'Rejected {len(self.inliers) - self.inliers.sum()} outlier pulse pairs from the fit.')
+            
+        #Fit the polynomial
+        self.fit = np.polynomial.polynomial.Polynomial.fit(self.harp_timestamps[self.inliers], self.pxie_timestamps[self.inliers], 1)
+        #Extract intercept and slope
+        self.intercept = self.fit.convert().coef[0]
+        self.slope = self.fit.convert().coef[1]
+
+        # Residuals of all pulse pairs, including rejected ones
+        self.predicted = self.get_pxie_timestamp(self.harp_timestamps)
+        self.residuals = self.pxie_timestamps - self.predicted
+        self.qc = self.get_qc()
+
+    def get_qc(self):
+        '''
+        Returns numeric QC of the fit: number of pulses in each clock, number
+        of pulse pairs kept for the fit, number of pulses (of either clock)
+        rejected from the fit (unpaired, or in an outlier pair), max and RMS
+        residual (ms) of the pairs kept for the fit, and the slope as a clock
+        drift in ppm.
+        '''
+        residuals = self.residuals[self.inliers]
+        n_pulses = int(self.inliers.sum())
+        return {
+            'fit_method': self.fit_method,
+            'n_harp_pulses': int(self.n_harp_pulses),
+            'n_pxie_pulses': int(self.n_pxie_pulses),
+            'n_pulses': n_pulses,
+            'n_rejected': int(self.n_harp_pulses + self.n_pxie_pulses - 2 * n_pulses),
+            'max_residual_ms': float(np.abs(residuals).max() * 1e3),
+            'rms_residual_ms': float(np.sqrt(np.mean(residuals ** 2)) * 1e3),
+            'slope_ppm': float((self.slope - 1) * 1e6),
+            'intercept_s': float(self.intercept),
+        }
+    
+    def save(self):
+        '''
+        Saves the mapping (timestamp_mapping.pkl) and its numeric QC
+        (timestamp_mapping_qc.json), so batch jobs can gate on it, in the
+        output session directory.
+        '''
+        with open(join(self.output_session_dir, 'timestamp_mapping.pkl'), 'wb') as file:
+            pickle.dump(self, file)
+
+        with open(join(self.output_session_dir, 'timestamp_mapping_qc.json'), 'w') as file:
+            json.dump(self.qc, file, indent=4)
+
+    def get_pxie_timestamp(self, new_data):
+        '''
+        Uses the linear fit to return pxie timestamps when given harp timestamps
+        '''
+        pxie_timestamp = self.fit(new_data)
+        return pxie_timestamp
+
+    def get_harp_timestamp(self, new_data):
+        '''
+        Inverts the linear fit to return harp timestamps when given pxie timestamps
+        '''
+        harp_timestamp = (np.asarray(new_data, dtype=float) - self.intercept) / self.slope
+        return harp_timestamp
+    
+    def plot_residuals(self):
+        '''
+        Plots the residuals of the  conversion. USeful to check 
+        if  there  are any outliers. Rejected pulse pairs are plotted separately.
+        '''
+        import matplotlib.pyplot as plt
+
+        #and plot the stuff
+        fig, ax =  plt.subplots()
+        ax.hist([self.residuals[self.inliers], self.residuals[~self.inliers]], stacked=True, label=['kept', 'rejected'])
+        ax.legend()
+        ax.set_xlabel('Actual-predicted pxie timestamp (s)')
+        ax.set_ylabel('Count')
+        fig.suptitle('Residuals from harp-pxie timestamp mapping')
+        fig.savefig(join(self.output_session_dir, 'harp_residuals.png'))
+
+class sample_index_mapping():
+    '''
+    Maps between ephys global timestamps and sample indices of a continuous
+    stream (e.g. ProbeA). The sample numbers and local timestamps are
+    memory-mapped from .npy files, so arbitrarily many events can be mapped
+    with searchsorted without loading the continuous data. Global timestamps
+    are a linear transform of the stream's local timestamps
+    (global = scaling * local + offset).
+    '''
+    def __init__(self, sample_numbers_path, timestamps_path, scaling = 1.0, offset = 0.0):
+        self.sample_numbers_path = sample_numbers_path
+        self.timestamps_path = timestamps_path
+        self.scaling = float(scaling)
+        self.offset = float(offset)
+
+    @classmethod
+    def from_continuous(cls, continuous, output_session_dir, stream_name = 'ProbeA', scaling = 1.0, offset = 0.0):
+        '''
+        Creates the mapping from an Open-Ephys continuous data object, given the
+        mapping of its local clock to the master clock (see fit_sync_lines). If
+        its sample numbers or timestamps are not memory-mapped from disk, they
+        are saved as .npy files in the output session directory.
+        '''
+        paths = []
+        for name in ['sample_numbers', 'timestamps']:
+            array = getattr(continuous, name)
+            path = getattr(array, 'filename', None)
+            if path is None:
+                path = join(output_session_dir, f'{stream_name}_{name}.npy')
+                np.save(path, np.asarray(array))
+            paths.append(str(path))
+
+        return cls(paths[0], paths[1], scaling, offset)
+
+    def __getstate__(self):
+        # Do not pickle the memory maps, only the paths to them
+        state = self.__dict__.copy()
+        state.pop('_sample_numbers', None)
+        state.pop('_timestamps', None)
+        return state
+
+    @property
+    def sample_numbers(self):
+        if getattr(self, '_sample_numbers', None) is None:
+            self._sample_numbers = np.load(self.sample_numbers_path, mmap_mode='r')
+        return self._sample_numbers
+
+    @property
+    def timestamps(self):
+        if getattr(self, '_timestamps', None) is None:
+            self._timestamps = np.load(self.timestamps_path, mmap_mode='r')
+        return self._timestamps
+
+    def get_sample_index(self, global_timestamps):
+        '''
+        Returns the index (into the continuous data) of the sample closest in
+        time to each global timestamp, or -1 for timestamps that are NaN or
+        more than half a sample period before the first or after the last
+        sample (i.e. outside the recording).
+        '''
+        global_timestamps = np.asarray(global_timestamps, dtype=float)
+        local = np.ravel((global_timestamps - self.offset) / self.scaling)
+        timestamps = self.timestamps
+        n = len(timestamps)
+
+        # Without a sample period, only the time of a single sample maps to it
+        if n <= 1:
+            sample_index = np.full(local.shape, -1, dtype=np.int64)
+            if n == 1:
+                sample_index[local == timestamps[0]] = 0
+            return sample_index.reshape(global_timestamps.shape)[()]
+
+        # Sort queries so that searchsorted walks the memory map in order
+        # (NaNs are sorted last and flagged as outside below)
+        order = np.argsort(local, kind='stable')
+        right = np.searchsorted(timestamps, local[order]).clip(1, n - 1)
+        left = right - 1
+        closer_left = np.abs(local[order] - timestamps[left]) <= np.abs(timestamps[right] - local[order])
+
+        sample_index = np.empty(local.shape, dtype=np.int64)
+        sample_index[order] = np.where(closer_left, left, right)
+
+        # Flag queries outside the recording
+        half_period = 0.5 * (timestamps[-1] - timestamps[0]) / (n - 1)
+        inside = (local >= timestamps[0] - half_period) & (local <= timestamps[-1] + half_period)
+        sample_index[~inside] = -1
+
+        # Same shape as the input (a scalar for a scalar)
+        return sample_index.reshape(global_timestamps.shape)[()]
+
+    def get_sample_number(self, global_timestamps):
+        '''
+        Returns the Open-Ephys sample number of the sample closest in time to
+        each global timestamp, or -1 for timestamps outside the recording.
+        '''
+        sample_index = np.asarray(self.get_sample_index(global_timestamps))
+        sample_numbers = np.full(sample_index.shape, -1, dtype=np.int64)
+        valid = sample_index >= 0
+        sample_numbers[valid] = self.sample_numbers[sample_index[valid]]
+        return sample_numbers[()]
+
+    def get_global_timestamp(self, sample_index):
+        '''
+        Returns the global timestamp of each sample index of the continuous
+        data, or NaN for a sample index of -1 (see get_sample_index).
+        '''
+        sample_index = np.asarray(sample_index, dtype=np.int64)
+        global_timestamps = np.full(sample_index.shape, np.nan)
+        valid = sample_index >= 0
+        global_timestamps[valid] = self.scaling * np.asarray(self.timestamps[sample_index[valid]], dtype=float) + self.offset
+        return global_timestamps[()]
+
+
+# -----------------------------------------------------------------------------
+# Load saved mappings
+# -----------------------------------------------------------------------------
+
+def _load_pickle(path):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def load_timestamp_mapping(output_session_dir):
+    """
+    Load the harp to ephys timestamp mapping saved by openephys_session.sync_harp_ttls.
+
+    Parameters:
+    output_session_dir (str): Output directory of the session.
+
+    Returns:
+    timestamp_mapping: The mapping (see get_pxie_timestamp and get_harp_timestamp).
+    """
+    return _load_pickle(join(output_session_dir, 'timestamp_mapping.pkl'))
+
+def load_sample_mapping(output_session_dir, stream_name = 'ProbeA'):
+    """
+    Load the ephys time to sample index mapping of a continuous stream saved by
+    openephys_session.map_probe_samples.
+
+    Parameters:
+    output_session_dir (str): Output directory of the session.
+    stream_name (str): Name of the continuous stream.
+
+    Returns:
+    sample_index_mapping: The mapping (see get_sample_index and get_global_timestamp).
+    """
+    return _load_pickle(join(output_session_dir, f'{stream_name}_sample_mapping.pkl'))
+
+def load_sync_mappings(output_session_dir):
+    """
+    Load the mappings of every synchronised ephys stream to the master clock
+    saved by openephys_session.sync_data.
+
+    Parameters:
+    output_session_dir (str): Output directory of the session.
+
+    Returns:
+    dict: Maps stream names to dictionaries with keys 'scaling' and 'offset' (global = scaling * local + offset), among others.
+    """
+    return _load_pickle(join(output_session_dir, 'sync_mappings.pkl'))
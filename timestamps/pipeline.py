@@ -0,0 +1,404 @@
+from os.path import join
+import hashlib
+import importlib
+import json
+import os
+import pickle
+
+import pandas as pd
+
+import timestamps
+from timestamps.catalog import get_session_fingerprint
+from timestamps.harp.get_harp_timestamps_df import harp_session, RAW_DATA_ROOT_DIR, OUTPUT_ROOT_DIR
+from timestamps.OpenEphys.open_ephys_utils import openephys_session, get_ttl_onsets, SYNC_LINES, TTL_LINE
+from timestamps.mapping import timestamp_mapping
+import timestamps.harp.validation as hv
+from timestamps.harp.experimental_data import TIMESTAMP_COLUMNS
+import timestamps.utils.qc_utils as qu
+
+# Stages of the pipeline, in order
+STAGES = ['decode', 'ttl_extraction', 'matching', 'fit', 'stream_mapping', 'export']
+
+# Stages whose outputs each stage uses
+STAGE_DEPENDENCIES = {
+    'decode': [],
+    'ttl_extraction': ['decode'],
+    'matching': ['ttl_extraction'],
+    'fit': ['matching'],
+    'stream_mapping': ['decode', 'ttl_extraction', 'fit'],
+    'export': ['stream_mapping'],
+}
+
+# Stages that read the raw data directly
+RAW_DATA_STAGES = ['decode', 'ttl_extraction']
+
+# Modules whose code each stage runs (besides this module). Their source is
+# part of the key of the stage, so editing them reruns it.
+STAGE_MODULES = {
+    'decode': ['timestamps.harp.get_harp_timestamps_df', 'timestamps.harp.utils', 'timestamps.harp.experimental_data'],
+    'ttl_extraction': ['timestamps.harp.get_harp_timestamps_df', 'timestamps.harp.utils', 'timestamps.harp.validation',
+                       'timestamps.OpenEphys.open_ephys_utils', 'timestamps.mapping', 'timestamps.utils.qc_utils'],
+    'matching': ['timestamps.OpenEphys.open_ephys_utils'],
+    'fit': ['timestamps.mapping'],
+    'stream_mapping': ['timestamps.mapping', 'timestamps.harp.get_harp_timestamps_df', 'timestamps.harp.event_log'],
+    'export': ['timestamps.harp.get_harp_timestamps_df', 'timestamps.harp.utils', 'timestamps.aligned_outputs'],
+}
+
+def get_source_hash(module_names):
+    """
+    Hash the source code of modules.
+
+    Parameters:
+    module_names (list of str): Names of the modules, e.g. 'timestamps.mapping'.
+
+    Returns:
+    str: Hex digest of the source of all modules.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(module_names):
+        with open(importlib.import_module(name).__file__, 'rb') as file:
+            digest.update(name.encode())
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def get_pipeline_version():
+    """
+    Version of the pipeline code: __version__ and a hash of the source of all
+    modules the stages run, so that any code change gives a new version.
+
+    Returns:
+    str: '{__version__}+{source hash}'.
+    """
+    modules = {name for names in STAGE_MODULES.values() for name in names} | {__name__}
+    return f'{timestamps.__version__}+{get_source_hash(modules)[:12]}'
+
+# Stream of the continuous data to map harp events to sample indices of
+PROBE_STREAM = 'ProbeA'
+
+class session_pipeline():
+    '''
+    Runs the alignment pipeline of a session as explicit stages (see STAGES),
+    each saving its outputs as a binary checkpoint (pickle) in the
+    'checkpoints' folder of the output session directory.
+
+    Every stage has a key computed from the pipeline version, the source code
+    of the modules it runs (see STAGE_MODULES), its parameters, the
+    fingerprint of the raw data (for stages reading it) and the keys of the
+    stages it depends on. checkpoints/manifest.json records, for the last
+    completed run of each stage, its key and the files it wrote in the output
+    session directory (besides plots). A stage is skipped, and its checkpoint
+    loaded only if a later stage needs it, when its key matches the manifest
+    and the files it wrote still exist. When a stage is rerun, files of its
+    previous run that it no longer writes (e.g. the timestamp mapping of a
+    session whose mapping QC now fails) are deleted. A failed run therefore
+    resumes from the last completed stage, and changing the raw data, the
+    code of a stage or a parameter only reruns the stages affected.
+    '''
+    def __init__(self, animal_ID, session_ID, raw_data_dir = RAW_DATA_ROOT_DIR, output_dir = OUTPUT_ROOT_DIR,
+                 sync_lines = SYNC_LINES, ttl_line = TTL_LINE, fit_method = 'robust', plot = False):
+
+        self.animal_ID = animal_ID
+        self.session_ID = session_ID
+        self.raw_data_root_dir = raw_data_dir
+        self.output_root_dir = output_dir
+        self.raw_data_session_dir = join(raw_data_dir, animal_ID, session_ID)
+        self.output_session_dir = join(output_dir, animal_ID, session_ID)
+        self.checkpoint_dir = join(self.output_session_dir, 'checkpoints')
+        self.plot = plot
+
+        # Parameters of each stage, part of its key
+        self.params = {
+            'decode': {},
+            'ttl_extraction': {'sync_lines': sync_lines, 'ttl_line': ttl_line, 'probe_stream': PROBE_STREAM},
+            'matching': {},
+            'fit': {'fit_method': fit_method},
+            'stream_mapping': {'timestamped_variables': TIMESTAMP_COLUMNS},
+            'export': {},
+        }
+
+        os.makedirs(self.checkpoint_dir, exist_ok = True)
+        self.manifest_path = join(self.checkpoint_dir, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as file:
+                self.manifest = json.load(file)
+        else:
+            self.manifest = {}
+
+        self.outputs = {}
+        self.keys = {}
+
+    #==========================================================================
+    # Checkpoints
+    #==========================================================================
+
+    def get_key(self, stage, source_fingerprint):
+        # Key of a stage from everything its outputs depend on
+        inputs = {
+            'stage': stage,
+            'pipeline_version': timestamps.__version__,
+            'code': get_source_hash(STAGE_MODULES[stage] + [__name__]),
+            'params': self.params[stage],
+            'source': source_fingerprint if stage in RAW_DATA_STAGES else None,
+            'dependencies': [self.keys[dependency] for dependency in STAGE_DEPENDENCIES[stage]],
+        }
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_checkpoint_path(self, stage):
+        return join(self.checkpoint_dir, f'{STAGES.index(stage)}_{stage}.pkl')
+
+    def get_output_paths(self, stage):
+        # Files written by the last completed run of a stage, from the manifest
+        entry = self.manifest.get(stage)
+        if not isinstance(entry, dict):
+            return []
+        return [join(self.output_session_dir, path) for path in entry['output_paths']]
+
+    def is_complete(self, stage):
+        entry = self.manifest.get(stage)
+        if not isinstance(entry, dict) or entry['key'] != self.keys[stage] or not os.path.exists(self.get_checkpoint_path(stage)):
+            return False
+        # A stage must be rerun if any file it wrote was deleted
+        return all(os.path.exists(path) for path in self.get_output_paths(stage))
+
+    def save_checkpoint(self, stage, outputs, output_paths):
+        # Write to a temporary file first, so an interrupted write never leaves a corrupt checkpoint
+        path = self.get_checkpoint_path(stage)
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump(outputs, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+        # Delete files of the previous run that this run no longer writes
+        for stale_path in set(self.get_output_paths(stage)) - set(output_paths):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+        self.manifest[stage] = {
+            'key': self.keys[stage],
+            'output_paths': sorted(os.path.relpath(path, self.output_session_dir) for path in output_paths),
+        }
+        with open(self.manifest_path + '.tmp', 'w') as file:
+            json.dump(self.manifest, file, indent=4)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def get_outputs(self, stage):
+        '''
+        Returns the outputs of a stage, loading its checkpoint if the stage was skipped.
+        '''
+        if stage not in self.outputs:
+            with open(self.get_checkpoint_path(stage), 'rb') as file:
+                self.outputs[stage] = pickle.load(file)
+        return self.outputs[stage]
+
+    def run(self):
+        '''
+        Runs all stages that are not complete, in order. Returns True if the
+        harp data was synced to the ephys master clock (TTL QC and mapping QC
+        passed).
+        '''
+        print(f"Starting analysis of {self.animal_ID} for session {self.session_ID}...")
+
+        source_fingerprint = get_session_fingerprint(self.raw_data_session_dir)
+        for stage in STAGES:
+            self.keys[stage] = self.get_key(stage, source_fingerprint)
+            if self.is_complete(stage):
+                print(f"Skipping stage '{stage}', inputs unchanged.")
+                continue
+
+            print(f"Running stage '{stage}'...")
+            outputs, output_paths = getattr(self, f'run_{stage}')()
+            self.save_checkpoint(stage, outputs, output_paths)
+            self.outputs[stage] = outputs
+
+        print(f"Finished analysis of {self.animal_ID} for session {self.session_ID}.")
+
+        return self.get_outputs('fit')['tm'] is not None
+
+    #==========================================================================
+    # Stages
+    #==========================================================================
+
+    # Each stage returns its outputs and the paths of the files it wrote in the
+    # output session directory (besides plots)
+
+    def get_harp_session(self, decode = False):
+        return harp_session(self.animal_ID, self.session_ID, self.raw_data_root_dir, self.output_root_dir, decode = decode)
+
+    def run_decode(self):
+        # Read in harp data streams and experimental-data .csv
+        harp = self.get_harp_session(decode = True)
+        return {
+            'sound_events': harp.sound_events,
+            'photodiode_data': harp.photodiode_data,
+            'poke_events': harp.poke_events,
+            'trials_df': harp.trials_df,
+        }, []
+
+    def run_ttl_extraction(self):
+        decoded = self.get_outputs('decode')
+        params = self.params['ttl_extraction']
+
+        # Read TTls from harp and OpenEphys
+        harp = self.get_harp_session()
+        harp.read_ttl(save_csv = False)
+        # Sessions without ephys TTLs (no recording, missing stream, or too few
+        # sync pulses) fail the TTL QC below instead of stopping the pipeline
+        sync_error = None
+        try:
+            oe = openephys_session(self.animal_ID, self.session_ID, self.raw_data_root_dir, self.output_root_dir,
+                                   sync_lines = params['sync_lines'], ttl_line = params['ttl_line'])
+            oe.read_TTLs()
+            oe.map_probe_samples(params['probe_stream'])
+            TTL_pulses, sync_mappings, sm = oe.TTL_pulses, oe.sync_mappings, oe.sm
+            # Sample numbers and timestamps are only saved if not memory-mapped from the raw data
+            output_paths = [join(self.output_session_dir, 'sync_mappings.pkl'),
+                            join(self.output_session_dir, f"{params['probe_stream']}_sample_mapping.pkl")]
+            output_paths += [path for path in [sm.sample_numbers_path, sm.timestamps_path]
+                             if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.output_session_dir)]
+        except ValueError as error:
+            oe, sync_error = None, str(error)
+            TTL_pulses = pd.DataFrame({'timestamp': [], 'state': [], 'global_timestamp': []})
+            sync_mappings, sm = None, None
+            output_paths = []
+
+        # Check harp stream timestamps are monotonic, without duplicates or gaps
+        stream_validation = hv.validate_streams(decoded['poke_events'], decoded['photodiode_data'], harp.ttl_state_df, decoded['sound_events'],
+                                               harp.ttl_set_times, harp.ttl_clear_times)
+        output_paths.append(join(self.output_session_dir, 'harp_stream_validation.csv'))
+        stream_validation.to_csv(output_paths[-1])
+        if not stream_validation['passed'].all():
+            print("WARNING: harp stream timestamps failed validation:")
+            print(stream_validation[~stream_validation['passed']].to_string())
+
+        # Check TTLs exist in both harp and OpenEphys, and look as expected
+        ttl_qc = qu.check_ttls(harp.ttl_state_df, TTL_pulses)
+        if sync_error is not None:
+            ttl_qc['passed'] = False
+            ttl_qc['reasons'].insert(0, f"ephys: streams could not be synchronised ({sync_error})")
+        output_paths.append(join(self.output_session_dir, 'TTL_qc.json'))
+        with open(output_paths[-1], 'w') as file:
+            json.dump(ttl_qc, file, indent=4)
+        if not ttl_qc['passed']:
+            print("TTL QC failed, harp data will not be synced to the ephys master clock:")
+            for reason in ttl_qc['reasons']:
+                print(f"  - {reason}")
+
+        if self.plot:
+            if len(harp.ttl_state_df):
+                harp.plot_ttl(100)
+            if len(TTL_pulses):
+                oe.plot_TTLs(100)
+
+        return {
+            'ttl_state_df': harp.ttl_state_df,
+            'TTL_pulses': TTL_pulses,
+            'sync_mappings': sync_mappings,
+            'sample_mapping': sm,
+            'stream_validation': stream_validation,
+            'ttl_qc': ttl_qc,
+        }, output_paths
+
+    def run_matching(self):
+        extracted = self.get_outputs('ttl_extraction')
+        if not extracted['ttl_qc']['passed']:
+            return {'harp_onset': None, 'pxie_onset': None}, []
+
+        harp_onset, pxie_onset = get_ttl_onsets(extracted['ttl_state_df'], extracted['TTL_pulses'])
+        return {'harp_onset': harp_onset, 'pxie_onset': pxie_onset}, []
+
+    def run_fit(self):
+        matched = self.get_outputs('matching')
+        if matched['harp_onset'] is None:
+            return {'tm': None, 'mapping_qc': None}, []
+
+        # Fit the harp to ephys mapping, and only sync to the ephys master
+        # clock if the QC of the fit passes
+        try:
+            tm = timestamp_mapping(matched['harp_onset'], matched['pxie_onset'], self.output_session_dir, self.params['fit']['fit_method'])
+        except ValueError as error:
+            mapping_qc = {'passed': False, 'reasons': [f"harp to ephys mapping could not be fitted ({error})"]}
+            tm = None
+        else:
+            mapping_qc = qu.check_mapping(tm.qc)
+            tm.qc.update(mapping_qc)
+            if self.plot:
+                tm.plot_residuals()
+
+        output_paths = [join(self.output_session_dir, 'timestamp_mapping_qc.json')]
+        if mapping_qc['passed']:
+            tm.save()
+            output_paths.append(join(self.output_session_dir, 'timestamp_mapping.pkl'))
+        else:
+            print("Mapping QC failed, harp data will not be synced to the ephys master clock:")
+            for reason in mapping_qc['reasons']:
+                print(f"  - {reason}")
+            with open(output_paths[0], 'w') as file:
+                json.dump(tm.qc if tm is not None else mapping_qc, file, indent=4)
+            tm = None
+
+        return {'tm': tm, 'mapping_qc': mapping_qc}, output_paths
+
+    def run_stream_mapping(self):
+        decoded = self.get_outputs('decode')
+        extracted = self.get_outputs('ttl_extraction')
+        tm = self.get_outputs('fit')['tm']
+
+        sound_events = decoded['sound_events'].copy()
+        poke_events = decoded['poke_events'].copy()
+        photodiode_data = decoded['photodiode_data'].copy()
+        trials_df_ephys = None
+
+        if tm is not None:
+            sm = extracted['sample_mapping']
+
+            # Sync harp data streams to ephys master clock, and map them to
+            # sample indices of the probe continuous data
+            for df, harp_timestamp in [
+                (sound_events, sound_events['Time']),
+                (poke_events, poke_events.index),
+                (photodiode_data, photodiode_data.index),
+            ]:
+                df['ephys_timestamp'] = tm.get_pxie_timestamp(harp_timestamp)
+                df['ephys_sample_index'] = sm.get_sample_index(df['ephys_timestamp'])
+
+            # Construct a new data frame the same as trials_df but with harp clock
+            # timestamps replaced with ephys clock timestamps
+            trials_df_ephys = decoded['trials_df'].copy()
+            # Only convert variables present in this version of the Bonsai workflow
+            timestamped_variables = self.params['stream_mapping']['timestamped_variables']
+            for var in [var for var in timestamped_variables if var in trials_df_ephys.columns]:
+                trials_df_ephys[var] = tm.get_pxie_timestamp(trials_df_ephys[var])
+
+        # Merge all harp event streams into a single event log
+        harp = self.get_harp_session()
+        harp.poke_events, harp.sound_events, harp.photodiode_data = poke_events, sound_events, photodiode_data
+        harp.trials_df = decoded['trials_df']
+        harp.ttl_state_df = extracted['ttl_state_df']
+        harp.get_event_log(tm)
+
+        return {
+            'sound_events': sound_events,
+            'poke_events': poke_events,
+            'photodiode_data': photodiode_data,
+            'trials_df_ephys': trials_df_ephys,
+            'event_log': harp.event_log,
+        }, []
+
+    def run_export(self):
+        mapped = self.get_outputs('stream_mapping')
+
+        harp = self.get_harp_session()
+        harp.sound_events = mapped['sound_events']
+        harp.poke_events = mapped['poke_events']
+        harp.photodiode_data = mapped['photodiode_data']
+        harp.event_log = mapped['event_log']
+
+        # Save harp data (in ephys time if synced, otherwise only in harp time)
+        output_paths = harp.save_harp_data_streams()
+        output_paths += harp.save_event_log()
+
+        # Save trials_df with ephys timestamps
+        if mapped['trials_df_ephys'] is not None:
+            harp.trials_df_ephys = mapped['trials_df_ephys']
+            output_paths.append(harp.save_experiment_csv())
+
+        return {}, output_paths
@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 
 #==============================================================================
@@ -17,6 +16,9 @@ def get_square_wave(df):
 
 def plot_ttl_trace(ttl_state_df, *, t_start, t_end):
 
+    # Import matplotlib only when plotting, so that headless runs skip it
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(12, 6))  # Set the figure size (width, height) in inches
     ttl_pulse = get_square_wave(ttl_state_df)
     ttl_pulse.plot(x='timestamp', y='state', linewidth=0.5, ax=ax)
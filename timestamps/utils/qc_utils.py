@@ -0,0 +1,152 @@
+import numpy as np
+
+from timestamps.OpenEphys.open_ephys_utils import get_ttl_onsets
+
+#==============================================================================
+# TTL QC
+#==============================================================================
+
+# Thresholds for TTL QC. Set a threshold to None to skip the check (the metric
+# is still reported). Glitched, missing or extra pulses are handled by the
+# robust harp to ephys fit, so checks they would fail are off by default, and
+# the sync is gated on the QC of the fit instead (MAPPING_QC_THRESHOLDS).
+TTL_QC_THRESHOLDS = {
+    'min_pulses': 10,                           # minimum number of TTL pulse onsets in each clock
+    'max_alternation_errors': None,             # consecutive events with the same state
+    'max_pulse_count_difference': None,         # difference in number of pulse onsets between clocks
+    'min_pulse_width_ms': None,                 # shorter pulses are treated as glitches
+    'max_inter_pulse_interval_ms': None,        # longest allowed gap between pulse onsets
+    'max_median_interval_difference_ms': 1,     # median inter-pulse interval must agree between clocks
+}
+
+# Thresholds for the QC of the harp to ephys mapping (timestamp_mapping.qc).
+# Set a threshold to None to skip the check.
+MAPPING_QC_THRESHOLDS = {
+    'min_pulses': 10,                           # minimum number of pulse pairs kept for the fit
+    'max_rejected_fraction': 0.05,              # pulses (of either clock) rejected from the fit, as a fraction of all pulses
+    'max_residual_ms': 1,                       # max residual of the pulse pairs kept for the fit
+}
+
+def _summary_ms(intervals):
+    # Min, median and max of intervals (s), in milliseconds
+    if len(intervals) == 0:
+        return {'min': np.nan, 'median': np.nan, 'max': np.nan}
+    return {
+        'min': float(intervals.min() * 1e3),
+        'median': float(np.median(intervals) * 1e3),
+        'max': float(intervals.max() * 1e3),
+    }
+
+def get_ttl_metrics(ttl_df, onset = None, time_column = 'timestamp'):
+    """
+    Compute summary metrics of a stream of TTL events.
+
+    Parameters:
+    ttl_df (pd.DataFrame): TTL events sorted by time, with a 'state' column (1 for onset, 0 for offset)
+        and a time column in seconds (e.g. harp.ttl_state_df or oe.TTL_pulses).
+    onset (np.ndarray): Boolean mask of the events that are pulse onsets. Defaults to all events with state 1.
+    time_column (str): Name of the time column.
+
+    Returns:
+    dict: Number of events and pulses (onsets), number of alternation errors (consecutive events with the
+        same state), and min/median/max of pulse widths and inter-pulse intervals (onset to onset) in ms.
+    """
+    state = ttl_df['state'].to_numpy()
+    t = ttl_df[time_column].to_numpy(dtype=float)
+    if onset is None:
+        onset = state == 1
+
+    # Pulse widths from each onset immediately followed by an offset
+    width_idx = np.flatnonzero(onset[:-1] & (state[1:] == 0))
+
+    return {
+        'n_events': int(len(state)),
+        'n_pulses': int(onset.sum()),
+        'alternation_errors': int(np.count_nonzero(state[1:] == state[:-1])),
+        'pulse_width_ms': _summary_ms(t[width_idx + 1] - t[width_idx]),
+        'inter_pulse_interval_ms': _summary_ms(np.diff(t[onset])),
+    }
+
+def check_ttls(harp_ttl_df, ephys_ttl_df, thresholds = TTL_QC_THRESHOLDS):
+    """
+    Check that the TTL pulses recorded by harp and by the ephys system exist,
+    look as expected and agree with each other, without plotting. Pulses are
+    counted from the onsets that are paired to fit the harp to ephys mapping
+    (see get_ttl_onsets).
+
+    Parameters:
+    harp_ttl_df (pd.DataFrame): Harp TTL events, with columns 'timestamp' and 'state' (harp.ttl_state_df).
+    ephys_ttl_df (pd.DataFrame): Ephys TTL events, with columns 'timestamp' and 'state' (oe.TTL_pulses).
+    thresholds (dict): QC thresholds (see TTL_QC_THRESHOLDS).
+
+    Returns:
+    dict: With keys
+        - passed (bool): Whether all checks passed, i.e. whether to fit the harp to ephys mapping.
+        - reasons (list of str): Description of each failed check.
+        - metrics (dict): Metrics of each clock (see get_ttl_metrics) and the difference between clocks.
+    """
+    # Onsets as paired by the fit
+    harp_onset, ephys_onset = get_ttl_onsets(harp_ttl_df, ephys_ttl_df)
+    metrics = {
+        'harp': get_ttl_metrics(harp_ttl_df, harp_ttl_df.index.isin(harp_onset.index)),
+        'ephys': get_ttl_metrics(ephys_ttl_df, ephys_ttl_df.index.isin(ephys_onset.index)),
+    }
+    metrics['pulse_count_difference'] = metrics['harp']['n_pulses'] - metrics['ephys']['n_pulses']
+    metrics['median_interval_difference_ms'] = abs(
+        metrics['harp']['inter_pulse_interval_ms']['median'] - metrics['ephys']['inter_pulse_interval_ms']['median']
+    )
+
+    reasons = []
+    for clock in ['harp', 'ephys']:
+        m = metrics[clock]
+        if thresholds.get('min_pulses') is not None and m['n_pulses'] < thresholds['min_pulses']:
+            reasons.append(f"{clock}: {m['n_pulses']} TTL pulse onsets, fewer than {thresholds['min_pulses']}")
+        if thresholds.get('max_alternation_errors') is not None and m['alternation_errors'] > thresholds['max_alternation_errors']:
+            reasons.append(f"{clock}: {m['alternation_errors']} TTL events with the same state as the previous event")
+        if thresholds.get('min_pulse_width_ms') is not None and m['pulse_width_ms']['min'] < thresholds['min_pulse_width_ms']:
+            reasons.append(f"{clock}: shortest pulse is {m['pulse_width_ms']['min']:.3f} ms, below {thresholds['min_pulse_width_ms']} ms")
+        if thresholds.get('max_inter_pulse_interval_ms') is not None and m['inter_pulse_interval_ms']['max'] > thresholds['max_inter_pulse_interval_ms']:
+            reasons.append(f"{clock}: longest inter-pulse interval is {m['inter_pulse_interval_ms']['max']:.3f} ms, above {thresholds['max_inter_pulse_interval_ms']} ms")
+
+    if thresholds.get('max_pulse_count_difference') is not None and abs(metrics['pulse_count_difference']) > thresholds['max_pulse_count_difference']:
+        reasons.append(f"{metrics['harp']['n_pulses']} harp pulse onsets but {metrics['ephys']['n_pulses']} ephys pulse onsets to pair")
+    # NaN (too few pulses to compare) fails this check too
+    if thresholds.get('max_median_interval_difference_ms') is not None and not metrics['median_interval_difference_ms'] <= thresholds['max_median_interval_difference_ms']:
+        reasons.append(f"median inter-pulse interval differs by {metrics['median_interval_difference_ms']:.3f} ms between clocks, above {thresholds['max_median_interval_difference_ms']} ms")
+
+    return {
+        'passed': len(reasons) == 0,
+        'reasons': reasons,
+        'metrics': metrics,
+    }
+
+def check_mapping(mapping_qc, thresholds = MAPPING_QC_THRESHOLDS):
+    """
+    Check the numeric QC of the harp to ephys mapping, to decide whether to
+    sync harp data to the ephys master clock.
+
+    Parameters:
+    mapping_qc (dict): QC of the mapping (timestamp_mapping.qc).
+    thresholds (dict): QC thresholds (see MAPPING_QC_THRESHOLDS).
+
+    Returns:
+    dict: With keys
+        - passed (bool): Whether all checks passed, i.e. whether to sync to the master clock.
+        - reasons (list of str): Description of each failed check.
+    """
+    reasons = []
+    if thresholds.get('min_pulses') is not None and mapping_qc['n_pulses'] < thresholds['min_pulses']:
+        reasons.append(f"{mapping_qc['n_pulses']} pulse pairs kept for the fit, fewer than {thresholds['min_pulses']}")
+
+    n_all = mapping_qc['n_harp_pulses'] + mapping_qc['n_pxie_pulses']
+    rejected_fraction = mapping_qc['n_rejected'] / n_all if n_all else 1.0
+    if thresholds.get('max_rejected_fraction') is not None and rejected_fraction > thresholds['max_rejected_fraction']:
+        reasons.append(f"{mapping_qc['n_rejected']} of {n_all} pulses rejected from the fit, more than {thresholds['max_rejected_fraction']:.0%}")
+
+    if thresholds.get('max_residual_ms') is not None and not mapping_qc['max_residual_ms'] <= thresholds['max_residual_ms']:
+        reasons.append(f"max residual of the fit is {mapping_qc['max_residual_ms']:.3f} ms, above {thresholds['max_residual_ms']} ms")
+
+    return {
+        'passed': len(reasons) == 0,
+        'reasons': reasons,
+    }